@@ -0,0 +1,109 @@
+from comfy_execution.graph_utils import is_link, GraphBuilder
+from comfy_execution.graph import DynamicPrompt, ExecutionBlocker
+
+# A small executor with the parts of ComfyUI's execution model this pack relies on: lazy inputs and
+# check_lazy_status round trips, node expansion (with the expanding node's result resolved once its subgraph has
+# run), rawLink and hidden inputs, and execution blockers. It is iterative, so 10k-iteration loops don't need a
+# deep Python stack. No caching between runs and no validation -- it is only meant for measuring the pack.
+
+class MiniExecutor:
+    def __init__(self, mappings, prompt):
+        self.mappings = mappings
+        self.dynprompt = DynamicPrompt(prompt)
+        self.outputs = {}
+        self.objects = {}
+        self.pending = {}
+        self.executions = 0
+        self.lazy_checks = 0
+        self.expanded_nodes = 0
+
+    def input_info(self, input_types, key):
+        for category in ("required", "optional", "hidden"):
+            if key in input_types.get(category, {}):
+                info = input_types[category][key]
+                options = info[1] if isinstance(info, tuple) and len(info) > 1 and isinstance(info[1], dict) else {}
+                return category, options
+        return None, None
+
+    def run(self, targets):
+        stack = list(targets)
+        while len(stack) > 0:
+            node_id = stack[-1]
+            if node_id in self.outputs:
+                stack.pop()
+                continue
+            if node_id in self.pending:
+                result = self.pending[node_id]
+                missing = [value[0] for value in result if is_link(value) and value[0] not in self.outputs]
+                if len(missing) > 0:
+                    stack.extend(missing)
+                    continue
+                self.outputs[node_id] = tuple(self.outputs[value[0]][value[1]] if is_link(value) else value for value in result)
+                del self.pending[node_id]
+                stack.pop()
+                continue
+            stack.extend(self.step(node_id))
+        return {node_id: self.outputs[node_id] for node_id in targets}
+
+    def step(self, node_id):
+        """Executes node_id if it can, otherwise returns the nodes it is waiting on"""
+        node = self.dynprompt.get_node(node_id)
+        class_def = self.mappings[node["class_type"]]
+        input_types = class_def.INPUT_TYPES()
+        inputs = {}
+        missing = []
+        lazy_links = {}
+        for key, value in node["inputs"].items():
+            category, options = self.input_info(input_types, key)
+            if category is None:
+                continue
+            if is_link(value) and not options.get("rawLink", False):
+                if value[0] in self.outputs:
+                    inputs[key] = self.outputs[value[0]][value[1]]
+                elif options.get("lazy", False):
+                    inputs[key] = None
+                    lazy_links[key] = value
+                else:
+                    missing.append(value[0])
+            else:
+                inputs[key] = value
+        if len(missing) > 0:
+            return missing
+        if getattr(class_def, "INPUT_IS_LIST", False):
+            # Every output here is a single item rather than a list (OUTPUT_IS_LIST isn't supported)
+            inputs = {key: [value] for key, value in inputs.items()}
+        for key, value in input_types.get("hidden", {}).items():
+            if value == "DYNPROMPT":
+                inputs[key] = self.dynprompt
+            elif value == "UNIQUE_ID":
+                inputs[key] = node_id
+
+        obj = self.objects.get(node_id, None)
+        if obj is None:
+            obj = class_def()
+            self.objects[node_id] = obj
+        if hasattr(obj, "check_lazy_status"):
+            self.lazy_checks += 1
+            requested = obj.check_lazy_status(**inputs) or []
+            requested = [lazy_links[key][0] for key in requested if key in lazy_links]
+            if len(requested) > 0:
+                return requested
+
+        for value in inputs.values():
+            if isinstance(value, ExecutionBlocker):
+                self.outputs[node_id] = tuple([value] * len(class_def.RETURN_TYPES))
+                return []
+
+        GraphBuilder.set_default_prefix(node_id, 0, 0)
+        self.executions += 1
+        result = getattr(obj, class_def.FUNCTION)(**inputs)
+        if isinstance(result, dict) and "expand" in result:
+            for new_id, new_node in result["expand"].items():
+                self.dynprompt.add_ephemeral_node(new_id, new_node, node_id, new_node.get("override_display_id", node_id))
+            self.expanded_nodes += len(result["expand"])
+            self.pending[node_id] = result["result"]
+        elif isinstance(result, dict):
+            self.outputs[node_id] = result.get("result", ())
+        else:
+            self.outputs[node_id] = result
+        return []
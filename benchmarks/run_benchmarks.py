@@ -0,0 +1,278 @@
+"""Headless benchmarks for this node pack.
+
+Runs the pack's loop, accumulation, prompt parsing, component and validation code paths at a range of sizes
+against minimal stand-ins for ComfyUI (see standins/) and prints machine-readable results:
+
+    python benchmarks/run_benchmarks.py [--quick] [--only NAME ...] [--repeat N] [--output results.json]
+
+Each case runs in its own process so that its peak RSS can be reported. Requires torch, numpy, pillow and
+safetensors (the same packages ComfyUI itself needs), but no GPU and no ComfyUI install.
+"""
+import argparse
+import importlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+PACK_DIR = os.path.dirname(BENCHMARK_DIR)
+PACK_NAME = "inversion_demo"
+
+def load_pack():
+    """Imports the pack's modules under a synthetic package, without running its __init__ (which would try to
+    install the frontend extension and register server routes)"""
+    sys.path.insert(0, os.path.join(BENCHMARK_DIR, "standins"))
+    sys.path.insert(0, BENCHMARK_DIR)
+    package = types.ModuleType(PACK_NAME)
+    package.__path__ = [PACK_DIR]
+    sys.modules[PACK_NAME] = package
+    mappings = {}
+    for module_name, mapping_name in [
+            ("nodes", "GENERAL_NODE_CLASS_MAPPINGS"),
+            ("components", "COMPONENT_NODE_CLASS_MAPPINGS"),
+            ("flow_control", "FLOW_CONTROL_NODE_CLASS_MAPPINGS"),
+            ("utility_nodes", "UTILITY_NODE_CLASS_MAPPINGS"),
+            ("conditions", "CONDITION_NODE_CLASS_MAPPINGS")]:
+        module = importlib.import_module("%s.%s" % (PACK_NAME, module_name))
+        mappings.update(getattr(module, mapping_name))
+    import nodes
+    nodes.NODE_CLASS_MAPPINGS.update(mappings)
+    return mappings
+
+def run_prompt(mappings, prompt, targets):
+    from executor import MiniExecutor
+    executor = MiniExecutor(mappings, prompt)
+    outputs = executor.run(targets)
+    return outputs, {"executions": executor.executions, "lazy_checks": executor.lazy_checks, "expanded_nodes": executor.expanded_nodes}
+
+def for_loop_prompt(iterations, body_nodes):
+    # The body is a chain of additions starting from the loop's running value, so every node depends on the open
+    prompt = {
+        "open": {"class_type": "ForLoopOpen", "inputs": {"remaining": iterations, "initial_value1": 0}},
+    }
+    previous = ["open", 2]
+    for i in range(body_nodes):
+        prompt["body%d" % i] = {"class_type": "IntMathOperation", "inputs": {"a": previous, "b": 1, "operation": "add"}}
+        previous = ["body%d" % i, 0]
+    prompt["close"] = {"class_type": "ForLoopClose", "inputs": {"flow_control": ["open", 0], "initial_value1": previous}}
+    return prompt
+
+def bench_for_loop(mappings, iterations, body_nodes):
+    outputs, stats = run_prompt(mappings, for_loop_prompt(iterations, body_nodes), ["close"])
+    assert outputs["close"][0] == iterations * body_nodes
+    return stats
+
+def bench_while_loop(mappings, iterations, body_nodes):
+    prompt = {
+        "open": {"class_type": "WhileLoopOpen", "inputs": {"condition": True, "initial_value0": 0}},
+    }
+    previous = ["open", 1]
+    for i in range(body_nodes):
+        prompt["body%d" % i] = {"class_type": "IntMathOperation", "inputs": {"a": previous, "b": 1, "operation": "add"}}
+        previous = ["body%d" % i, 0]
+    prompt["condition"] = {"class_type": "IntConditions", "inputs": {"a": previous, "b": iterations * body_nodes, "operation": "<"}}
+    prompt["close"] = {"class_type": "WhileLoopClose", "inputs": {"flow_control": ["open", 0], "condition": ["condition", 0], "initial_value0": previous}}
+    outputs, stats = run_prompt(mappings, prompt, ["close"])
+    assert outputs["close"][0] == iterations * body_nodes
+    return stats
+
+def bench_accumulation(mappings, iterations, item_shape):
+    import torch
+    class BenchmarkTensor:
+        @classmethod
+        def INPUT_TYPES(cls):
+            return {"required": {"index": ("INT",)}}
+        RETURN_TYPES = ("IMAGE",)
+        FUNCTION = "make"
+        def make(self, index):
+            return (torch.full(item_shape, float(index)),)
+    mappings = dict(mappings)
+    mappings["BenchmarkTensor"] = BenchmarkTensor
+    prompt = {
+        "open": {"class_type": "ForLoopOpen", "inputs": {"remaining": iterations}},
+        "item": {"class_type": "BenchmarkTensor", "inputs": {"index": ["open", 1]}},
+        "accumulate": {"class_type": "AccumulateNode", "inputs": {"to_add": ["item", 0], "accumulation": ["open", 2]}},
+        "close": {"class_type": "ForLoopClose", "inputs": {"flow_control": ["open", 0], "initial_value1": ["accumulate", 0]}},
+    }
+    outputs, stats = run_prompt(mappings, prompt, ["close"])
+    assert len(outputs["close"][0]["accum"]) == iterations
+    return stats
+
+def bench_sweep(mappings, values, shared_nodes, body_nodes):
+    # A chain of shared nodes feeds every value's body, and should only run once
+    prompt = {
+        "open": {"class_type": "SweepOpen", "inputs": {"values": list(range(values))}},
+    }
+    shared = 0
+    for i in range(shared_nodes):
+        prompt["shared%d" % i] = {"class_type": "IntMathOperation", "inputs": {"a": shared, "b": 1, "operation": "add"}}
+        shared = ["shared%d" % i, 0]
+    previous = ["open", 1]
+    for i in range(body_nodes):
+        prompt["body%d" % i] = {"class_type": "IntMathOperation", "inputs": {"a": previous, "b": shared, "operation": "add"}}
+        previous = ["body%d" % i, 0]
+    prompt["close"] = {"class_type": "SweepClose", "inputs": {"flow_control": ["open", 0], "result": previous}}
+    outputs, stats = run_prompt(mappings, prompt, ["close"])
+    assert outputs["close"][0]["accum"] == [value + body_nodes * shared_nodes for value in range(values)]
+    return stats
+
+def bench_parse_timesteps(mappings, segments):
+    node = mappings["InversionDemoAdvancedPromptNode"]()
+    # Alternating edits spread over the schedule, plus loras and weights that need the colon escaping
+    text = ", ".join("[subject %d:other %d:%.3f] (detail %d:1.2) <lora:style%d.safetensors:0.5>" % (i, i, (i + 1) / (segments + 1), i, i) for i in range(segments))
+    cleaned, loras = node.parse_loras(text)
+    timesteps = node.parse_timesteps(cleaned)
+    return {"prompt_length": len(text), "timesteps": len(timesteps), "loras": len(loras)}
+
+def bench_expand_component(mappings, component_nodes, expansions):
+    components = importlib.import_module("%s.components" % PACK_NAME)
+    from comfy_execution.graph import DynamicPrompt
+    graph = {
+        "input": {"class_type": "ComponentInput", "inputs": {"name": "value", "data_type": "INT", "extra_args": "", "explicit_input_order": 0, "optional": False, "default_value": 0}},
+    }
+    previous = ["input", 0]
+    for i in range(component_nodes):
+        graph["n%d" % i] = {"class_type": "IntMathOperation", "inputs": {"a": previous, "b": i, "operation": "add"}}
+        previous = ["n%d" % i, 0]
+    graph["output"] = {"class_type": "ComponentOutput", "inputs": {"name": "result", "index": 0, "data_type": "INT", "value": previous}}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "BenchmarkComponent.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"output": graph}, f)
+        components.LoadComponent(path)
+    node = components.COMPONENT_NODE_CLASS_MAPPINGS["BenchmarkComponent"]()
+    dynprompt = DynamicPrompt({"c": {"class_type": "BenchmarkComponent", "inputs": {"value": 0}}})
+    expanded = 0
+    for i in range(expansions):
+        result = node.expand_component(dynprompt=dynprompt, unique_id="c", value=i)
+        expanded += len(result["expand"])
+    return {"expanded_nodes": expanded}
+
+def bench_validate_inputs(mappings, calls):
+    classes = [class_def for class_def in mappings.values() if hasattr(class_def, "VALIDATE_INPUTS")]
+    cases = []
+    for class_def in classes:
+        types = class_def.INPUT_TYPES()
+        cases.append((class_def, {key: value[0] for key, value in list(types.get("required", {}).items()) + list(types.get("optional", {}).items()) if isinstance(value, tuple) and isinstance(value[0], str)}))
+    for i in range(calls):
+        class_def, input_types = cases[i % len(cases)]
+        class_def.VALIDATE_INPUTS(input_types=input_types)
+    return {"classes": len(classes)}
+
+BENCHMARKS = {
+    "for_loop": (bench_for_loop, [
+        {"iterations": 10, "body_nodes": 10},
+        {"iterations": 100, "body_nodes": 10},
+        {"iterations": 1000, "body_nodes": 10},
+        {"iterations": 10000, "body_nodes": 10},
+        {"iterations": 100, "body_nodes": 100},
+        {"iterations": 10, "body_nodes": 1000},
+        {"iterations": 100, "body_nodes": 1000},
+    ]),
+    "while_loop": (bench_while_loop, [
+        {"iterations": 10, "body_nodes": 10},
+        {"iterations": 1000, "body_nodes": 10},
+        {"iterations": 10000, "body_nodes": 10},
+        {"iterations": 100, "body_nodes": 1000},
+    ]),
+    "accumulation": (bench_accumulation, [
+        {"iterations": 100, "item_shape": [1, 64, 64, 3]},
+        {"iterations": 1000, "item_shape": [1, 64, 64, 3]},
+        {"iterations": 10000, "item_shape": [1, 8, 8, 3]},
+    ]),
+    "sweep": (bench_sweep, [
+        {"values": 10, "shared_nodes": 10, "body_nodes": 10},
+        {"values": 100, "shared_nodes": 100, "body_nodes": 10},
+        {"values": 10, "shared_nodes": 10, "body_nodes": 1000},
+    ]),
+    "parse_timesteps": (bench_parse_timesteps, [
+        {"segments": 4},
+        {"segments": 64},
+        {"segments": 256},
+    ]),
+    "expand_component": (bench_expand_component, [
+        {"component_nodes": 10, "expansions": 1000},
+        {"component_nodes": 100, "expansions": 100},
+        {"component_nodes": 1000, "expansions": 10},
+    ]),
+    "validate_inputs": (bench_validate_inputs, [
+        {"calls": 100000},
+    ]),
+}
+
+# The first case of each benchmark, for a fast smoke run
+QUICK_CASES = 1
+
+def run_case(name, params, repeat):
+    mappings = load_pack()
+    function = BENCHMARKS[name][0]
+    timings = []
+    extra = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        extra = function(mappings, **params)
+        timings.append(time.perf_counter() - start)
+    # A separate run for Python allocations, since tracing them slows everything down
+    tracemalloc.start()
+    function(mappings, **params)
+    python_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "benchmark": name,
+        "params": params,
+        "seconds": timings,
+        "best_seconds": min(timings),
+        "peak_python_bytes": python_peak,
+        # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+        "peak_rss_bytes": rss if sys.platform == "darwin" else rss * 1024,
+        "stats": extra,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--quick", action="store_true", help="Only run the smallest case of each benchmark")
+    parser.add_argument("--only", nargs="*", choices=sorted(BENCHMARKS.keys()), help="Benchmarks to run")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per case")
+    parser.add_argument("--output", help="Write results to this file instead of stdout")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case is not None:
+        # We're the child process for a single case
+        case = json.loads(args.case)
+        print(json.dumps(run_case(case["benchmark"], case["params"], args.repeat)))
+        return
+
+    results = []
+    for name in args.only or sorted(BENCHMARKS.keys()):
+        cases = BENCHMARKS[name][1]
+        for params in cases[:QUICK_CASES] if args.quick else cases:
+            command = [sys.executable, os.path.abspath(__file__), "--repeat", str(args.repeat), "--case", json.dumps({"benchmark": name, "params": params})]
+            process = subprocess.run(command, capture_output=True, text=True)
+            if process.returncode != 0:
+                results.append({"benchmark": name, "params": params, "error": process.stderr.strip().split("\n")[-1]})
+            else:
+                results.append(json.loads(process.stdout.strip().split("\n")[-1]))
+            print("%s %s: %s" % (name, params, "%.4fs" % results[-1]["best_seconds"] if "best_seconds" in results[-1] else results[-1]["error"]), file=sys.stderr)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2 @@
+# Minimal stand-ins for the parts of ComfyUI's comfy_execution package this pack uses, so that its nodes can be
+# benchmarked without a ComfyUI install. They follow the behaviour of the real modules, not their performance.
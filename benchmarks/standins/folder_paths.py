@@ -0,0 +1,28 @@
+import os
+import tempfile
+
+# Stand-in for ComfyUI's folder_paths. Everything the benchmarks write goes to a scratch directory.
+base_path = os.path.join(tempfile.gettempdir(), "inversion_demo_benchmarks")
+
+def get_output_directory():
+    return os.path.join(base_path, "output")
+
+def get_temp_directory():
+    return os.path.join(base_path, "temp")
+
+def get_user_directory():
+    return os.path.join(base_path, "user")
+
+def get_save_image_path(filename_prefix, output_dir, image_width=0, image_height=0):
+    subfolder = os.path.dirname(os.path.normpath(filename_prefix))
+    filename = os.path.basename(os.path.normpath(filename_prefix))
+    full_output_folder = os.path.join(output_dir, subfolder)
+    counter = 1
+    if os.path.exists(full_output_folder):
+        for existing in os.listdir(full_output_folder):
+            if existing.startswith(filename + "_"):
+                try:
+                    counter = max(counter, int(existing[len(filename) + 1:].split("_")[0]) + 1)
+                except ValueError:
+                    pass
+    return full_output_folder, filename, counter, subfolder, filename_prefix
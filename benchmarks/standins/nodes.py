@@ -0,0 +1,2 @@
+# Stand-in for ComfyUI's nodes module. The benchmark runner registers the pack's classes here.
+NODE_CLASS_MAPPINGS = {}
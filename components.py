@@ -5,6 +5,9 @@ import json
 import copy
 import comfy_execution.graph_utils
 from .tools import VariantSupport
+from .expansion import alloc_prefix
+from .graph_passes import finalize_expansion
+from .tracing import span
 
 comfy_path = os.path.dirname(folder_paths.__file__)
 js_path = os.path.join(comfy_path, "web", "extensions")
@@ -183,6 +186,10 @@ def LoadComponent(component_file):
             return {
                 "required": {node["name"]: (node["data_type"], default_extra_data(node["data_type"], node["extra_args"])) for node in component_inputs if not node["optional"]},
                 "optional": {node["name"]: (node["data_type"], default_extra_data(node["data_type"], node["extra_args"])) for node in component_inputs if node["optional"]},
+                "hidden": {
+                    "dynprompt": "DYNPROMPT",
+                    "unique_id": "UNIQUE_ID",
+                },
             }
 
         RETURN_TYPES = tuple([node["data_type"] for node in component_outputs])
@@ -192,17 +199,15 @@ def LoadComponent(component_file):
         CATEGORY = "Custom Components"
         OUTPUT_NODE = is_output_component
 
-        def expand_component(self, **kwargs):
-            new_graph = copy.deepcopy(graph)
+        def expand_component(self, dynprompt=None, unique_id=None, **kwargs):
+            with span("expand_component.deepcopy", "expansion", node=unique_id, component=component_raw_name):
+                new_graph = copy.deepcopy(graph)
             for input_node in component_inputs:
                 if input_node["name"] in kwargs:
                     new_graph[input_node["node_id"]]["inputs"]["default_value"] = kwargs[input_node["name"]]
             outputs = tuple([[node["node_id"], 0] for node in component_outputs])
-            new_graph, outputs = comfy_execution.graph_utils.add_graph_prefix(new_graph, outputs, comfy_execution.graph_utils.GraphBuilder.alloc_prefix())
-            return {
-                "result": outputs,
-                "expand": new_graph,
-            }
+            new_graph, outputs = comfy_execution.graph_utils.add_graph_prefix(new_graph, outputs, alloc_prefix(unique_id))
+            return finalize_expansion(new_graph, outputs, dynprompt, unique_id)
     ComponentNode.__name__ = component_raw_name
     COMPONENT_NODE_CLASS_MAPPINGS[component_raw_name] = ComponentNode
     COMPONENT_NODE_DISPLAY_NAME_MAPPINGS[component_raw_name] = component_display_name
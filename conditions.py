@@ -21,6 +21,7 @@ class IntConditions:
     FUNCTION = "int_condition"
 
     CATEGORY = "InversionDemo Nodes/Logic"
+    PURE = True
 
     def int_condition(self, a, b, operation):
         if operation == "==":
@@ -56,6 +57,7 @@ class FloatConditions:
     FUNCTION = "float_condition"
 
     CATEGORY = "InversionDemo Nodes/Logic"
+    PURE = True
 
     def float_condition(self, a, b, operation):
         if operation == "==":
@@ -91,6 +93,7 @@ class StringConditions:
     FUNCTION = "string_condition"
 
     CATEGORY = "InversionDemo Nodes/Logic"
+    PURE = True
 
     def string_condition(self, a, b, operation, case_sensitive):
         if not case_sensitive:
@@ -113,6 +116,28 @@ class StringConditions:
         elif operation == "a ENDSWITH b":
             return (a.endswith(b),)
 
+# Large tensors are checked this many elements at a time so we can stop at the first chunk with a nonzero value
+TO_BOOL_CHUNK_ELEMENTS = 1 << 22
+
+def tensor_any(value):
+    if value.dim() == 0 or value.nelement() <= TO_BOOL_CHUNK_ELEMENTS:
+        return bool(value.any().item())
+    try:
+        # Chunks of a flat view, so that a single large frame is split up too
+        flat = value.view(-1)
+    except RuntimeError:
+        # Not viewable as one dimension (e.g. non-contiguous), so chunk along the first dimension, which still
+        # gives views rather than copies
+        rows_per_chunk = max(1, TO_BOOL_CHUNK_ELEMENTS // (value.nelement() // value.shape[0]))
+        for start in range(0, value.shape[0], rows_per_chunk):
+            if value[start:start + rows_per_chunk].any().item():
+                return True
+        return False
+    for start in range(0, flat.nelement(), TO_BOOL_CHUNK_ELEMENTS):
+        if flat[start:start + TO_BOOL_CHUNK_ELEMENTS].any().item():
+            return True
+    return False
+
 @VariantSupport()
 class ToBoolNode:
     def __init__(self):
@@ -133,13 +158,11 @@ class ToBoolNode:
     FUNCTION = "to_bool"
 
     CATEGORY = "InversionDemo Nodes/Logic"
+    PURE = True
 
     def to_bool(self, value, invert = False):
         if isinstance(value, torch.Tensor):
-            if value.max().item() == 0 and value.min().item() == 0:
-                result = False
-            else:
-                result = True
+            result = tensor_any(value)
         else:
             try:
                 result = bool(value)
@@ -171,6 +194,7 @@ class BoolOperationNode:
     FUNCTION = "bool_operation"
 
     CATEGORY = "InversionDemo Nodes/Logic"
+    PURE = True
 
     def bool_operation(self, a, b, op):
         if op == "a AND b":
@@ -0,0 +1,108 @@
+import atexit
+import functools
+import json
+import random
+import threading
+import time
+from .tools import setting, value_nbytes
+
+# Set INVERSION_DEMO_COUNTERS=1 to count calls, time, output sizes and expansion sizes for every node class of this
+# pack. The counters can be read from /inversion_demo/counters, and are written to INVERSION_DEMO_COUNTERS_FILE
+# (if set) when the server exits.
+COLLECT_COUNTERS = setting("counters", False)
+COUNTERS_FILE = setting("counters_file", "")
+
+# Durations kept per class to estimate percentiles from
+COUNTER_SAMPLES = 1024
+
+class ClassCounters:
+    def __init__(self):
+        self.calls = 0
+        self.total_ns = 0
+        self.samples = []
+        self.output_bytes = 0
+        self.expansions = 0
+        self.expanded_nodes = 0
+        self.max_expanded_nodes = 0
+
+    def add(self, duration_ns, result):
+        self.calls += 1
+        self.total_ns += duration_ns
+        # Reservoir sampling keeps an unbiased sample of all durations in constant memory
+        if len(self.samples) < COUNTER_SAMPLES:
+            self.samples.append(duration_ns)
+        else:
+            index = random.randrange(self.calls)
+            if index < COUNTER_SAMPLES:
+                self.samples[index] = duration_ns
+        if isinstance(result, dict) and "expand" in result:
+            self.expansions += 1
+            self.expanded_nodes += len(result["expand"])
+            self.max_expanded_nodes = max(self.max_expanded_nodes, len(result["expand"]))
+        elif isinstance(result, tuple):
+            self.output_bytes += value_nbytes(result)
+
+    def summary(self):
+        samples = sorted(self.samples)
+        p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))] if len(samples) > 0 else 0
+        return {
+            "calls": self.calls,
+            "total_ms": self.total_ns / 1e6,
+            "mean_ms": self.total_ns / 1e6 / self.calls if self.calls > 0 else 0.0,
+            "p95_ms": p95 / 1e6,
+            "output_bytes": self.output_bytes,
+            "expansions": self.expansions,
+            "expanded_nodes": self.expanded_nodes,
+            "max_expanded_nodes": self.max_expanded_nodes,
+        }
+
+_counters = {}
+_lock = threading.Lock()
+
+def counters_enabled():
+    return COLLECT_COUNTERS
+
+def counted(function, class_name):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter_ns()
+        result = function(*args, **kwargs)
+        duration = time.perf_counter_ns() - start
+        with _lock:
+            if class_name not in _counters:
+                _counters[class_name] = ClassCounters()
+            _counters[class_name].add(duration, result)
+        return result
+    return wrapper
+
+def counter_summary():
+    with _lock:
+        return {class_name: counters.summary() for class_name, counters in sorted(_counters.items())}
+
+def reset_counters():
+    with _lock:
+        _counters.clear()
+
+def dump_counters(path):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(counter_summary(), f, indent=2)
+
+def setup_counter_routes():
+    if not COLLECT_COUNTERS:
+        return
+    if COUNTERS_FILE != "":
+        atexit.register(dump_counters, COUNTERS_FILE)
+    try:
+        from server import PromptServer
+        from aiohttp import web
+    except ImportError:
+        return
+    if PromptServer.instance is None:
+        return
+
+    @PromptServer.instance.routes.get("/inversion_demo/counters")
+    async def get_counters(request):
+        summary = counter_summary()
+        if request.rel_url.query.get("reset", "") in ("1", "true"):
+            reset_counters()
+        return web.json_response(summary)
@@ -0,0 +1,30 @@
+import hashlib
+from comfy_execution.graph_utils import GraphBuilder
+
+# Expansions made by this pack get short prefixes of the form "x<hash>." rather than GraphBuilder's default of
+# "<parent id>.<call index>.<graph index>.". The default repeats the whole ID of the expanding node, so IDs
+# grow with every level of nesting -- and with every iteration of a loop, since each iteration is expanded
+# by the previous one.
+#
+# The hash is derived from GraphBuilder's default prefix (the expanding node's ID and call index) and the loop
+# iteration only, so re-running the same workflow produces the same IDs and the executor's cache can match them.
+# Inputs are left out: the cache already compares them, and hashing carried tensors every iteration is not free.
+
+def _base36(value):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    result = ""
+    while True:
+        value, digit = divmod(value, 36)
+        result = digits[digit] + result
+        if value == 0:
+            return result
+
+def alloc_prefix(parent_id=None, iteration=0):
+    # GraphBuilder's default prefix is unique within the prompt (it includes the call index for nodes that are
+    # executed once per list item), so we mix it in to make sure two expansions never get the same prefix.
+    key = "%s|%s|%d" % (GraphBuilder.alloc_prefix(), parent_id, iteration)
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+    return "x%s." % _base36(int.from_bytes(digest, "big"))
+
+def expansion_graph(parent_id=None, iteration=0):
+    return GraphBuilder(prefix=alloc_prefix(parent_id, iteration))
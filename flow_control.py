@@ -1,8 +1,219 @@
-from comfy_execution.graph_utils import GraphBuilder, is_link
+import hashlib
+import os
+from comfy_execution.graph_utils import is_link
 from comfy_execution.graph import ExecutionBlocker
-from .tools import VariantSupport
+from .tools import VariantSupport, fingerprint, prompt_state, loop_node_state, setting, describe_node, BoundedMemo
+from .expansion import expansion_graph
+from .graph_passes import finalize_expansion, cse_eligible, forget_common_subexpression
+from .storage import storage_directory, save_values, load_values, delete_values
+from .tracing import span
+from .memory import record_memory
 
 NUM_FLOW_SOCKETS = 5
+
+# Results gathered by a single Sweep Gather node. Larger sweeps chain several of them.
+NUM_GATHER_INPUTS = 64
+
+# Limit on the loop iterations run by a whole prompt, across all of its loops. Off (0) unless set, since nested
+# loops legitimately multiply up to large totals.
+MAX_LOOP_ITERATIONS = setting("max_loop_iterations", 0)
+
+# Limit on the size of the results kept by Disk Cache nodes, which are shared by all of them. The least recently
+# used results are deleted first.
+DISK_CACHE_MB = setting("disk_cache_mb", 10240)
+
+def explore_dependencies(node_id, dynprompt, upstream):
+    # Iterative rather than recursive so that long loop bodies don't hit the recursion limit
+    to_visit = [node_id]
+    while len(to_visit) > 0:
+        node_id = to_visit.pop()
+        node_info = dynprompt.get_node(node_id)
+        if "inputs" not in node_info:
+            continue
+        for k, v in node_info["inputs"].items():
+            if is_link(v):
+                parent_id = v[0]
+                if parent_id not in upstream:
+                    upstream[parent_id] = []
+                    to_visit.append(parent_id)
+                upstream[parent_id].append(node_id)
+
+def collect_contained(node_id, upstream, contained):
+    to_visit = [node_id]
+    while len(to_visit) > 0:
+        node_id = to_visit.pop()
+        for child_id in upstream.get(node_id, []):
+            if child_id not in contained:
+                contained[child_id] = True
+                to_visit.append(child_id)
+
+def release_iteration(dynprompt, node_ids):
+    # Once the close node of an iteration runs, every other node of that iteration has finished and its
+    # outputs have been copied into the next iteration's open node as literal values. Nothing will look
+    # these nodes up again, so we drop their definitions (including those literal inputs) from the dynamic
+    # prompt, which keeps the prompt and the graph walks of later iterations from growing with every iteration.
+    # This only trims the prompt: the executor's output cache is out of our reach and still holds each
+    # iteration's outputs until the prompt ends. We keep the parent/display mappings so IDs still resolve.
+    # Nodes that the released ones expanded into (e.g. the While Loop Open that a For Loop Open becomes, which
+    # holds the iteration's values as literals) are finished too, and go with them.
+    ephemeral_prompt = getattr(dynprompt, "ephemeral_prompt", None)
+    if ephemeral_prompt is None:
+        return
+    state = prompt_state(dynprompt)
+    expansion_children = state.get("expansion_children", {})
+    clones = state.get("loop_close_clones", set())
+    to_release = list(node_ids)
+    while len(to_release) > 0:
+        node_id = to_release.pop()
+        ephemeral_prompt.pop(node_id, None)
+        forget_common_subexpression(dynprompt, node_id)
+        # e.g. the last close node of a nested loop, which never expanded
+        clones.discard(node_id)
+        to_release.extend(expansion_children.pop(node_id, []))
+
+def find_loop_body(open_node, unique_id, dynprompt):
+    upstream = {}
+    # Get the list of all nodes between the open and close nodes
+    explore_dependencies(unique_id, dynprompt, upstream)
+
+    contained = {}
+    collect_contained(open_node, upstream, contained)
+    contained[unique_id] = True
+    contained[open_node] = True
+    return contained
+
+def invariant_outputs(open_node, unique_id, dynprompt, offset):
+    """Returns the outputs of the open node whose values are passed straight back into the close node, and so are the
+    same in every iteration. initial_value<i> of the close node carries output i + offset of the open node."""
+    inputs = dynprompt.get_node(unique_id)["inputs"]
+    invariant = set()
+    for i in range(NUM_FLOW_SOCKETS):
+        value = inputs.get("initial_value%d" % i, None)
+        if is_link(value) and value[0] == open_node and value[1] == i + offset:
+            invariant.add(i + offset)
+    return invariant
+
+def find_hoisted(open_node, unique_id, contained, dynprompt, invariant):
+    """Returns the nodes of a loop body that only depend on loop-invariant outputs of the open node. Their results are
+    the same in every iteration, so rather than cloning them, later iterations link to the ones that already ran."""
+    if len(invariant) == 0:
+        return set()
+    consumers = {}
+    variant = []
+    eligibility = {}
+    for node_id in contained:
+        if node_id == open_node or node_id == unique_id:
+            continue
+        node = dynprompt.get_node(node_id)
+        if not cse_eligible(node["class_type"], eligibility):
+            # e.g. output nodes, which should run in every iteration
+            variant.append(node_id)
+        for k, v in node["inputs"].items():
+            if is_link(v) and v[0] in contained:
+                consumers.setdefault(v[0], []).append(node_id)
+                if v[0] == open_node and v[1] not in invariant:
+                    variant.append(node_id)
+    varies = set(variant)
+    while len(variant) > 0:
+        for consumer in consumers.get(variant.pop(), []):
+            if consumer not in varies:
+                varies.add(consumer)
+                variant.append(consumer)
+    return set(node_id for node_id in contained if node_id not in varies and node_id != open_node and node_id != unique_id)
+
+def loop_body_signature(open_node, dynprompt):
+    """Returns a hash of the nodes of the while loops opened by open_node, and of everything outside those loops that
+    they read from, or None if that can't be determined"""
+    body = []
+    for close_id in sorted(dynprompt.all_node_ids()):
+        node = dynprompt.get_node(close_id)
+        link = node["inputs"].get("flow_control", None)
+        if node["class_type"] != "WhileLoopClose" or not is_link(link) or link[0] != open_node:
+            continue
+        contained = find_loop_body(open_node, close_id, dynprompt)
+        for node_id in sorted(contained):
+            if node_id == open_node:
+                # Its initial values are fingerprinted separately
+                continue
+            node = dynprompt.get_node(node_id)
+            inputs = {}
+            for key, value in node["inputs"].items():
+                if is_link(value) and value[0] not in contained:
+                    value = upstream_signature(dynprompt, value)
+                    if value is None:
+                        return None
+                inputs[key] = value
+            body.append([node_id, node["class_type"], inputs])
+    return fingerprint(body)
+
+def expand_loop_body(open_node, unique_id, dynprompt, open_inputs, iteration, contained=None, invariant=()):
+    if contained is None:
+        with span("find_loop_body", "loop", node=unique_id, iteration=iteration) as s:
+            contained = find_loop_body(open_node, unique_id, dynprompt)
+            s.set(body_nodes=len(contained))
+    hoisted = find_hoisted(open_node, unique_id, contained, dynprompt, invariant)
+    cloned = [node_id for node_id in contained if node_id not in hoisted]
+
+    # Clones are named by their position in the body rather than by the ID of the node they were cloned
+    # from, so IDs stay the same length no matter how many iterations deep we are.
+    local_ids = {}
+    for node_id in cloned:
+        local_ids[node_id] = "Recurse" if node_id == unique_id else str(len(local_ids))
+    graph = expansion_graph(unique_id, iteration)
+    for node_id in cloned:
+        original_node = dynprompt.get_node(node_id)
+        node = graph.node(original_node["class_type"], local_ids[node_id])
+        node.set_override_display_id(dynprompt.get_display_node_id(node_id))
+    for node_id in cloned:
+        original_node = dynprompt.get_node(node_id)
+        node = graph.lookup_node(local_ids[node_id])
+        for k, v in original_node["inputs"].items():
+            if is_link(v) and v[0] in local_ids:
+                parent = graph.lookup_node(local_ids[v[0]])
+                node.set_input(k, parent.out(v[1]))
+            else:
+                node.set_input(k, v)
+    new_open = graph.lookup_node(local_ids[open_node])
+    for key, value in open_inputs.items():
+        new_open.set_input(key, value)
+    # Only nodes created by the same expansion as this close node can go, and only if that expansion was made by
+    # this loop, i.e. this close node is a clone made by the previous iteration. The first iteration's nodes may be
+    # part of an enclosing loop's body, which that loop still needs to clone. (Display IDs can't tell the two
+    # apart: everything an expansion makes without an override shares the expanding node's display ID.) The close
+    # node itself is kept -- it is executed again to collect the results of the expansion -- and so are hoisted
+    # nodes, which every later iteration links to.
+    clones = prompt_state(dynprompt).setdefault("loop_close_clones", set())
+    if unique_id in clones:
+        clones.discard(unique_id)
+        parent_id = dynprompt.get_parent_node_id(unique_id)
+        release_iteration(dynprompt, [node_id for node_id in cloned if node_id != unique_id and dynprompt.get_parent_node_id(node_id) == parent_id])
+        # This close node is all that's left of what the previous one expanded into. It stays listed so that an
+        # enclosing loop releasing the chain of close nodes still reaches it.
+        children = prompt_state(dynprompt).get("expansion_children", {})
+        if parent_id in children:
+            children[parent_id] = [unique_id]
+    recurse = graph.lookup_node("Recurse")
+    clones.add(recurse.id)
+    return graph, recurse
+
+def checkpoint_prefix(name):
+    return "".join(c if c.isalnum() or c in "-_" else "_" for c in name)
+
+def checkpoint_files(name):
+    """Lists the files of the checkpoints saved under name, with their modification times"""
+    directory = storage_directory("checkpoints")
+    prefix = checkpoint_prefix(name) + "_"
+    files = []
+    for entry in sorted(os.listdir(directory)):
+        # Followed by the 24 digit key, which tells "a" and "a_b" apart
+        digest = entry[len(prefix):].split(".")[0]
+        if entry.startswith(prefix) and len(digest) == 24 and all(c in "0123456789abcdef" for c in digest):
+            try:
+                files.append((entry, os.stat(os.path.join(directory, entry)).st_mtime_ns))
+            except OSError:
+                pass
+    return files
+
 @VariantSupport()
 class WhileLoopOpen:
     def __init__(self):
@@ -15,6 +226,15 @@ class WhileLoopOpen:
                 "condition": ("BOOLEAN", {"default": True}),
             },
             "optional": {
+                # Every N iterations the carried values are saved, and a run of the loop that starts from the same
+                # initial values picks up from the last save instead of from the beginning
+                "checkpoint_every": ("INT", {"default": 0, "min": 0, "max": 1000000, "step": 1}),
+                "checkpoint_name": ("STRING", {"default": ""}),
+            },
+            "hidden": {
+                "dynprompt": "DYNPROMPT",
+                "unique_id": "UNIQUE_ID",
+                "iteration": ("INT",),
             },
         }
         for i in range(NUM_FLOW_SOCKETS):
@@ -27,12 +247,48 @@ class WhileLoopOpen:
 
     CATEGORY = "InversionDemo Nodes/Flow"
 
-    def while_loop_open(self, condition, **kwargs):
+    @classmethod
+    def IS_CHANGED(cls, checkpoint_every=0, checkpoint_name="", unique_id=None, **kwargs):
+        # An interrupted run leaves its checkpoint behind, and the next queue of the loop has to run this node to
+        # resume from it rather than take its outputs from the cache. Finished runs delete their checkpoints, so a
+        # loop that finished is still cached when it's queued again unchanged.
+        if checkpoint_every <= 0:
+            return False
+        return checkpoint_files(checkpoint_name if checkpoint_name != "" else "loop_%s" % unique_id)
+
+    def while_loop_open(self, condition, checkpoint_every=0, checkpoint_name="", dynprompt=None, unique_id=None, iteration=0, **kwargs):
         values = []
         for i in range(NUM_FLOW_SOCKETS):
             values.append(kwargs.get("initial_value%d" % i, None))
+        if checkpoint_every > 0 and iteration == 0 and dynprompt is not None:
+            values = self.resume(values, checkpoint_every, checkpoint_name, dynprompt, unique_id)
         return tuple(["stub"] + values)
 
+    def resume(self, values, checkpoint_every, checkpoint_name, dynprompt, unique_id):
+        display_id = dynprompt.get_display_node_id(unique_id)
+        key_fingerprint = fingerprint(values)
+        if key_fingerprint is None:
+            print("While loop %s can't be checkpointed: its initial values can't be fingerprinted" % display_id)
+            return values
+        # A checkpoint of a loop whose body has changed since would resume with values the new body didn't compute
+        body_fingerprint = loop_body_signature(unique_id, dynprompt)
+        if body_fingerprint is None:
+            print("While loop %s can't be checkpointed: its body reads from nodes whose outputs can't be fingerprinted" % display_id)
+            return values
+        name = checkpoint_name if checkpoint_name != "" else "loop_%s" % display_id
+        digest = hashlib.blake2b(("%s|%s|%s" % (name, key_fingerprint, body_fingerprint)).encode("utf-8"), digest_size=12).hexdigest()
+        path = os.path.join(storage_directory("checkpoints"), "%s_%s" % (checkpoint_prefix(name), digest))
+        checkpoint = {"path": path, "every": checkpoint_every, "offset": 0, "saved": 0}
+        stored = load_values(path)
+        if stored is not None:
+            values, metadata = stored
+            values = list(values)
+            checkpoint["offset"] = checkpoint["saved"] = metadata["iteration"]
+            print("While loop %s resuming from checkpoint at iteration %d" % (display_id, metadata["iteration"]))
+        # The close node (and each of its clones) finds this by the open node's display ID
+        prompt_state(dynprompt).setdefault("checkpoints", {})[display_id] = checkpoint
+        return values
+
 @VariantSupport()
 class WhileLoopClose:
     def __init__(self):
@@ -46,10 +302,15 @@ class WhileLoopClose:
                 "condition": ("BOOLEAN", {"forceInput": True}),
             },
             "optional": {
+                "memoize": ("BOOLEAN", {"default": False}),
+                "memo_max_entries": ("INT", {"default": 64, "min": 1, "max": 100000, "step": 1}),
+                "memo_max_mb": ("INT", {"default": 1024, "min": 0, "max": 1000000, "step": 1}),
             },
             "hidden": {
                 "dynprompt": "DYNPROMPT",
                 "unique_id": "UNIQUE_ID",
+                "iteration": ("INT",),
+                "memo_key": ("STRING",),
             }
         }
         for i in range(NUM_FLOW_SOCKETS):
@@ -62,74 +323,344 @@ class WhileLoopClose:
 
     CATEGORY = "InversionDemo Nodes/Flow"
 
-    def explore_dependencies(self, node_id, dynprompt, upstream):
-        node_info = dynprompt.get_node(node_id)
-        if "inputs" not in node_info:
-            return
-        for k, v in node_info["inputs"].items():
-            if is_link(v):
-                parent_id = v[0]
-                if parent_id not in upstream:
-                    upstream[parent_id] = []
-                    self.explore_dependencies(parent_id, dynprompt, upstream)
-                upstream[parent_id].append(node_id)
-
-    def collect_contained(self, node_id, upstream, contained):
-        if node_id not in upstream:
-            return
-        for child_id in upstream[node_id]:
-            if child_id not in contained:
-                contained[child_id] = True
-                self.collect_contained(child_id, upstream, contained)
+    def while_loop_close(self, flow_control, condition, dynprompt=None, unique_id=None, iteration=0, memoize=False, memo_max_entries=64, memo_max_mb=1024, memo_key=None, **kwargs):
+        values = []
+        for i in range(NUM_FLOW_SOCKETS):
+            values.append(kwargs.get("initial_value%d" % i, None))
 
+        contained = None
+        if memoize:
+            # Each iteration is told the fingerprint of the values it started with, so it can record what it
+            # produced from them. Later iterations (including those of other runs of this loop, e.g. when it is
+            # nested in another loop) that start from the same values can then skip the body.
+            memo = self.get_memo(dynprompt, unique_id, memo_max_entries, memo_max_mb)
+            if memo_key is not None:
+                memo.put(memo_key, (condition, tuple(values)))
+            # The body may also read from nodes outside the loop, which differ between runs of a nested loop
+            contained = find_loop_body(flow_control[0], unique_id, dynprompt)
+            context = self.body_context(contained, dynprompt)
+            seen = set()
+            memo_key = fingerprint([context, values])
+            while condition and memo_key is not None and memo_key in memo:
+                if memo_key in seen:
+                    raise Exception("While loop %s never terminates: its carried values repeat with the condition still true" % dynprompt.get_display_node_id(unique_id))
+                seen.add(memo_key)
+                condition, memo_values = memo.get(memo_key)
+                values = list(memo_values)
+                iteration += 1
+                memo_key = fingerprint([context, values])
 
-    def while_loop_close(self, flow_control, condition, dynprompt=None, unique_id=None, **kwargs):
+        record_memory(dynprompt, "loop %s carried values" % dynprompt.get_display_node_id(unique_id), values, iteration)
+        checkpoint = prompt_state(dynprompt).get("checkpoints", {}).get(dynprompt.get_display_node_id(flow_control[0]), None)
         if not condition:
             # We're done with the loop
-            values = []
-            for i in range(NUM_FLOW_SOCKETS):
-                values.append(kwargs.get("initial_value%d" % i, None))
+            if checkpoint is not None:
+                delete_values(checkpoint["path"])
             return tuple(values)
 
+        # Counted for the whole prompt, since loops can be nested in other loops or in sweeps
+        state = prompt_state(dynprompt)
+        state["loop_iterations"] = state.get("loop_iterations", 0) + 1
+        if MAX_LOOP_ITERATIONS > 0 and state["loop_iterations"] >= MAX_LOOP_ITERATIONS:
+            raise Exception("While loop %s is at iteration %d, bringing this prompt to %d loop iterations (the limit is set by INVERSION_DEMO_MAX_LOOP_ITERATIONS)" % (dynprompt.get_display_node_id(unique_id), iteration + 1, state["loop_iterations"]))
+
+        if checkpoint is not None:
+            self.save_checkpoint(checkpoint, values, iteration)
+
         # We want to loop
-        this_node = dynprompt.get_node(unique_id)
-        upstream = {}
-        # Get the list of all nodes between the open and close nodes
-        self.explore_dependencies(unique_id, dynprompt, upstream)
-
-        contained = {}
-        open_node = flow_control[0]
-        self.collect_contained(open_node, upstream, contained)
-        contained[unique_id] = True
-        contained[open_node] = True
-
-        # We'll use the default prefix, but to avoid having node names grow exponentially in size,
-        # we'll use "Recurse" for the name of the recursively-generated copy of this node.
-        graph = GraphBuilder()
-        for node_id in contained:
-            original_node = dynprompt.get_node(node_id)
-            node = graph.node(original_node["class_type"], "Recurse" if node_id == unique_id else node_id)
-            node.set_override_display_id(node_id)
-        for node_id in contained:
-            original_node = dynprompt.get_node(node_id)
-            node = graph.lookup_node("Recurse" if node_id == unique_id else node_id)
-            for k, v in original_node["inputs"].items():
-                if is_link(v) and v[0] in contained:
-                    parent = graph.lookup_node(v[0])
-                    node.set_input(k, parent.out(v[1]))
-                else:
-                    node.set_input(k, v)
-        new_open = graph.lookup_node(open_node)
+        open_inputs = {"iteration": iteration + 1}
         for i in range(NUM_FLOW_SOCKETS):
-            key = "initial_value%d" % i
-            new_open.set_input(key, kwargs.get(key, None))
-        my_clone = graph.lookup_node("Recurse" )
+            open_inputs["initial_value%d" % i] = values[i]
+        invariant = invariant_outputs(flow_control[0], unique_id, dynprompt, 1)
+        graph, my_clone = expand_loop_body(flow_control[0], unique_id, dynprompt, open_inputs, iteration + 1, contained, invariant)
+        my_clone.set_input("iteration", iteration + 1)
+        if memoize:
+            my_clone.set_input("memo_key", memo_key)
         result = map(lambda x: my_clone.out(x), range(NUM_FLOW_SOCKETS))
+        return finalize_expansion(graph, result, dynprompt, unique_id)
+
+    def save_checkpoint(self, checkpoint, values, iteration):
+        completed = checkpoint["offset"] + iteration + 1
+        if completed - checkpoint["saved"] < checkpoint["every"]:
+            return
+        try:
+            save_values(checkpoint["path"], values, {"iteration": completed})
+        except TypeError as e:
+            # e.g. a model is carried through the loop. Not worth failing the loop over.
+            print("Not checkpointing loop at iteration %d: %s" % (completed, e))
+        checkpoint["saved"] = completed
+
+    def get_memo(self, dynprompt, unique_id, max_entries, max_mb):
+        state = loop_node_state(dynprompt, unique_id, "loop_memos")
+        if "memo" not in state:
+            state["memo"] = BoundedMemo(max_entries, max_mb * 1024 * 1024)
+        return state["memo"]
+
+    def body_context(self, contained, dynprompt):
+        external = set()
+        for node_id in contained:
+            for k, v in dynprompt.get_node(node_id)["inputs"].items():
+                if is_link(v) and v[0] not in contained:
+                    external.add("%s:%s" % (v[0], v[1]))
+        return sorted(external)
+
+def batch_size(batch):
+    if isinstance(batch, dict):
+        return batch["samples"].shape[0]
+    return batch.shape[0]
+
+def batch_item(batch, index):
+    # Slicing (rather than indexing) keeps the batch dimension and returns a view, not a copy
+    if isinstance(batch, dict):
+        item = batch.copy()
+        item["samples"] = batch["samples"][index:index + 1]
+        # A mask with one frame per sample has to be sliced too, or every item would be masked with frame 0's mask
+        mask = batch.get("noise_mask", None)
+        if mask is not None and mask.dim() > 0 and mask.shape[0] == batch["samples"].shape[0]:
+            item["noise_mask"] = mask[index:index + 1]
+        item.pop("batch_index", None)
+        return item
+    return batch[index:index + 1]
+
+@VariantSupport()
+class BatchLoopOpen:
+    def __init__(self):
+        pass
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "batch": ("IMAGE,LATENT,MASK",),
+            },
+            "optional": {
+                "initial_value%d" % i: ("*",) for i in range(1, NUM_FLOW_SOCKETS)
+            },
+            "hidden": {
+                "initial_value0": ("*",)
+            }
+        }
+
+    RETURN_TYPES = tuple(["FLOW_CONTROL", "*", "INT"] + ["*"] * (NUM_FLOW_SOCKETS-1))
+    RETURN_NAMES = tuple(["flow_control", "item", "index"] + ["value%d" % i for i in range(1, NUM_FLOW_SOCKETS)])
+    FUNCTION = "batch_loop_open"
+
+    CATEGORY = "InversionDemo Nodes/Flow"
+
+    def batch_loop_open(self, batch, initial_value0=None, **kwargs):
+        # The loop state is carried through socket 0. The output buffer is allocated by the close node
+        # on the first iteration so that a cached open node never hands out a buffer from a previous run.
+        if initial_value0 is None:
+            # The keys of a latent other than its samples (e.g. batch_index) describe the whole batch, so they are
+            # kept for the close node to put back
+            extra = {key: value for key, value in batch.items() if key != "samples"} if isinstance(batch, dict) else None
+            state = {"index": 0, "count": batch_size(batch), "output": None, "extra": extra}
+        else:
+            state = initial_value0
+        index = state["index"]
+        outputs = [kwargs.get("initial_value%d" % i, None) for i in range(1, NUM_FLOW_SOCKETS)]
+        return tuple([state, batch_item(batch, index), index] + outputs)
+
+@VariantSupport()
+class BatchLoopClose:
+    def __init__(self):
+        pass
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "flow_control": ("FLOW_CONTROL",),
+                "result": ("*",),
+            },
+            "optional": {
+                "initial_value%d" % i: ("*",) for i in range(1, NUM_FLOW_SOCKETS)
+            },
+            "hidden": {
+                "dynprompt": "DYNPROMPT",
+                "unique_id": "UNIQUE_ID",
+            }
+        }
+
+    RETURN_TYPES = tuple(["*"] * NUM_FLOW_SOCKETS)
+    RETURN_NAMES = tuple(["output"] + ["value%d" % i for i in range(1, NUM_FLOW_SOCKETS)])
+    FUNCTION = "batch_loop_close"
+
+    CATEGORY = "InversionDemo Nodes/Flow"
+
+    def batch_loop_close(self, flow_control, result, dynprompt=None, unique_id=None, **kwargs):
+        state = flow_control
+        index = state["index"]
+        samples = result["samples"] if isinstance(result, dict) else result
+        rows = samples.shape[0]
+        output = state["output"]
+        if output is None:
+            output = samples.new_empty((state["count"] * rows,) + tuple(samples.shape[1:]))
+        output[index * rows:(index + 1) * rows].copy_(samples)
+
+        values = [kwargs.get("initial_value%d" % i, None) for i in range(1, NUM_FLOW_SOCKETS)]
+        record_memory(dynprompt, "loop %s carried values" % dynprompt.get_display_node_id(unique_id), [output] + values, index)
+        if index + 1 >= state["count"]:
+            # We're done with the loop
+            if isinstance(result, dict):
+                # Keep the other keys of the input latent (e.g. noise_mask, batch_index) and only replace the samples
+                latent = dict(state["extra"] or {})
+                latent.update(result)
+                latent["samples"] = output
+                output = latent
+            return tuple([output] + values)
+
+        open_node = dynprompt.get_node(unique_id)["inputs"]["flow_control"][0]
+        open_inputs = {"initial_value0": {"index": index + 1, "count": state["count"], "output": output, "extra": state["extra"]}}
+        for i in range(1, NUM_FLOW_SOCKETS):
+            open_inputs["initial_value%d" % i] = values[i - 1]
+        invariant = invariant_outputs(open_node, unique_id, dynprompt, 2)
+        graph, my_clone = expand_loop_body(open_node, unique_id, dynprompt, open_inputs, index + 1, invariant=invariant)
+        return finalize_expansion(graph, [my_clone.out(i) for i in range(NUM_FLOW_SOCKETS)], dynprompt, unique_id)
+
+def sweep_values(values):
+    # A single ACCUMULATION or Python list is swept over its items, otherwise we were given a list of values
+    # (e.g. from Make List)
+    if len(values) == 1 and isinstance(values[0], dict) and "accum" in values[0]:
+        return list(values[0]["accum"])
+    if len(values) == 1 and isinstance(values[0], list):
+        return list(values[0])
+    return list(values)
+
+@VariantSupport()
+class SweepOpen:
+    def __init__(self):
+        pass
+
+    @classmethod
+    def INPUT_TYPES(cls):
         return {
-            "result": tuple(result),
-            "expand": graph.finalize(),
+            "required": {
+                "values": ("*",),
+            },
         }
 
+    RETURN_TYPES = ("FLOW_CONTROL", "*")
+    RETURN_NAMES = ("flow_control", "value")
+    INPUT_IS_LIST = True
+    FUNCTION = "sweep_open"
+
+    CATEGORY = "InversionDemo Nodes/Flow"
+
+    def sweep_open(self, values):
+        # The body between this node and the close node is only a template that the close node clones once per
+        # value, so the original is blocked rather than run with a value of its own.
+        return ({"values": sweep_values(values)}, ExecutionBlocker(None))
+
+@VariantSupport()
+class SweepClose:
+    def __init__(self):
+        pass
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "flow_control": ("FLOW_CONTROL",),
+                "result": ("*", {"lazy": True}),
+            },
+            "hidden": {
+                "dynprompt": "DYNPROMPT",
+                "unique_id": "UNIQUE_ID",
+            },
+        }
+
+    RETURN_TYPES = ("ACCUMULATION",)
+    RETURN_NAMES = ("results",)
+    FUNCTION = "sweep_close"
+
+    CATEGORY = "InversionDemo Nodes/Flow"
+
+    def check_lazy_status(self, flow_control, result=None, dynprompt=None, unique_id=None):
+        # The result of the template body is never needed
+        return []
+
+    def sweep_close(self, flow_control, result=None, dynprompt=None, unique_id=None):
+        values = flow_control["values"]
+        if len(values) == 0:
+            return ({"accum": []},)
+        open_node = dynprompt.get_node(unique_id)["inputs"]["flow_control"][0]
+        result_link = dynprompt.get_node(unique_id)["inputs"]["result"]
+        # Only the nodes that depend on the swept value are cloned. Everything else (model loads, encodes of
+        # fixed prompts and so on) is linked to as it is, so it runs once for the whole sweep.
+        with span("find_loop_body", "loop", node=unique_id) as s:
+            contained = find_loop_body(open_node, unique_id, dynprompt)
+            s.set(body_nodes=len(contained))
+        body = [node_id for node_id in contained if node_id != open_node and node_id != unique_id]
+        local_ids = {node_id: str(i) for i, node_id in enumerate(body)}
+
+        graph = expansion_graph(unique_id)
+        results = []
+        for index, value in enumerate(values):
+            def resolve(link):
+                if not is_link(link):
+                    return link
+                if link[0] == open_node:
+                    return flow_control if link[1] == 0 else value
+                if link[0] in local_ids:
+                    return graph.lookup_node("%d_%s" % (index, local_ids[link[0]])).out(link[1])
+                return link
+            for node_id in body:
+                node = graph.node(dynprompt.get_node(node_id)["class_type"], "%d_%s" % (index, local_ids[node_id]))
+                node.set_override_display_id(dynprompt.get_display_node_id(node_id))
+            for node_id in body:
+                node = graph.lookup_node("%d_%s" % (index, local_ids[node_id]))
+                for k, v in dynprompt.get_node(node_id)["inputs"].items():
+                    node.set_input(k, resolve(v))
+            results.append(resolve(result_link))
+        # Gathered NUM_GATHER_INPUTS at a time rather than by a chain of Accumulate nodes, which copies the list
+        # for every value
+        accumulation = None
+        for start in range(0, len(results), NUM_GATHER_INPUTS):
+            chunk = results[start:start + NUM_GATHER_INPUTS]
+            gather = graph.node("SweepGather", count=len(chunk), accumulation=accumulation,
+                    **{"result%d" % i: result for i, result in enumerate(chunk)})
+            gather.set_override_display_id(dynprompt.get_display_node_id(unique_id))
+            accumulation = gather.out(0)
+        return finalize_expansion(graph, (accumulation,), dynprompt, unique_id)
+
+@VariantSupport()
+class SweepGather:
+    def __init__(self):
+        pass
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        inputs = {
+            "required": {
+                "count": ("INT", {"default": 1, "min": 0, "max": NUM_GATHER_INPUTS, "step": 1}),
+            },
+            "optional": {
+                "accumulation": ("ACCUMULATION",),
+            },
+            "hidden": {
+                "dynprompt": "DYNPROMPT",
+                "unique_id": "UNIQUE_ID",
+            },
+        }
+        # Sweep Close links result<i> to the result of the body cloned for the i-th value of a chunk
+        for i in range(NUM_GATHER_INPUTS):
+            inputs["optional"]["result%d" % i] = ("*",)
+        return inputs
+
+    RETURN_TYPES = ("ACCUMULATION",)
+    RETURN_NAMES = ("results",)
+    FUNCTION = "gather"
+
+    CATEGORY = "InversionDemo Nodes/Flow"
+
+    def gather(self, count, accumulation=None, dynprompt=None, unique_id=None, **kwargs):
+        added = [kwargs.get("result%d" % i, None) for i in range(count)]
+        value = added if accumulation is None else accumulation["accum"] + added
+        if dynprompt is not None:
+            record_memory(dynprompt, "accumulation %s" % dynprompt.get_display_node_id(unique_id), added, len(value), append=accumulation is not None)
+        return ({"accum": value},)
+
 @VariantSupport()
 class ExecutionBlockerNode:
     def __init__(self):
@@ -157,13 +688,161 @@ class ExecutionBlockerNode:
             return (ExecutionBlocker("Blocked Execution" if verbose else None),)
         return (input,)
 
+def upstream_signature(dynprompt, link):
+    """Returns a hash of everything that determines the value at link -- the classes and literal inputs of the
+    nodes upstream of it and how they are connected, but not their IDs -- or None if it can't be determined"""
+    import nodes
+    signatures = {}
+    stack = [(link[0], False)]
+    while len(stack) > 0:
+        node_id, ready = stack.pop()
+        if node_id in signatures:
+            continue
+        node = dynprompt.get_node(node_id)
+        if not ready:
+            stack.append((node_id, True))
+            stack.extend((v[0], False) for v in node["inputs"].values() if is_link(v) and v[0] not in signatures)
+            continue
+        inputs = {}
+        for key, value in node["inputs"].items():
+            if is_link(value):
+                if signatures[value[0]] is None:
+                    signatures[node_id] = None
+                    break
+                inputs[key] = ("link", signatures[value[0]], value[1])
+            else:
+                inputs[key] = ("literal", value)
+        else:
+            signature = [node["class_type"], inputs]
+            class_def = nodes.NODE_CLASS_MAPPINGS.get(node["class_type"], None)
+            if class_def is not None and hasattr(class_def, "IS_CHANGED"):
+                # e.g. Load Image, whose output changes when the file does. Their linked inputs are covered by the
+                # signature already, so only the literal ones are passed.
+                try:
+                    changed = class_def.IS_CHANGED(**{key: value for key, value in node["inputs"].items() if not is_link(value)})
+                except Exception:
+                    changed = float("NaN")
+                if isinstance(changed, float) and changed != changed:
+                    # NaN means it changes every time
+                    signatures[node_id] = None
+                    continue
+                signature.append(changed)
+            signatures[node_id] = fingerprint(signature)
+    if signatures[link[0]] is None:
+        return None
+    return fingerprint([signatures[link[0]], link[1]])
+
+def evict_cache_entries(directory, max_bytes):
+    # Entries are a .json description and (if they hold tensors) a .safetensors file. Hits touch the description,
+    # so its modification time orders the entries from least to most recently used.
+    entries = {}
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        base = name.split(".")[0]
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entry = entries.setdefault(base, {"bytes": 0, "used": 0})
+        entry["bytes"] += stat.st_size
+        if name.endswith(".json"):
+            entry["used"] = stat.st_mtime
+    total = sum(entry["bytes"] for entry in entries.values())
+    for base, entry in sorted(entries.items(), key=lambda item: item[1]["used"]):
+        if total <= max_bytes:
+            break
+        delete_values(os.path.join(directory, base))
+        total -= entry["bytes"]
+
+@VariantSupport()
+class DiskCacheNode:
+    def __init__(self):
+        self.hit = None
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "value": ("*", {"lazy": True}),
+            },
+            "optional": {
+                # Changing this invalidates previously stored results, e.g. after updating a custom node
+                "namespace": ("STRING", {"default": ""}),
+            },
+            "hidden": {
+                "dynprompt": "DYNPROMPT",
+                "unique_id": "UNIQUE_ID",
+            },
+        }
+
+    RETURN_TYPES = ("*",)
+    RETURN_NAMES = ("value",)
+    FUNCTION = "disk_cache"
+
+    CATEGORY = "InversionDemo Nodes/Flow"
+
+    def cache_path(self, namespace, dynprompt, unique_id):
+        link = dynprompt.get_node(unique_id)["inputs"]["value"]
+        if not is_link(link):
+            return None
+        with span("upstream_signature", "cache", node=unique_id):
+            signature = upstream_signature(dynprompt, link)
+        if signature is None:
+            return None
+        key = hashlib.blake2b(("%s|%s" % (namespace, signature)).encode("utf-8"), digest_size=16).hexdigest()
+        return os.path.join(storage_directory("cache"), key)
+
+    def check_lazy_status(self, value=None, namespace="", dynprompt=None, unique_id=None):
+        self.hit = None
+        if value is None and dynprompt is not None:
+            path = self.cache_path(namespace, dynprompt, unique_id)
+            # On a miss the node function needs the path again to store the value, so it isn't hashed twice
+            prompt_state(dynprompt).setdefault("disk_cache_paths", {})[unique_id] = path
+            stored = load_values(path) if path is not None else None
+            if stored is not None:
+                # The result is kept until the node function runs, which happens right after we return
+                self.hit = stored
+                os.utime(path + ".json")
+                return []
+        return ["value"] if value is None else []
+
+    def disk_cache(self, value=None, namespace="", dynprompt=None, unique_id=None):
+        if self.hit is not None:
+            value = self.hit[0]
+            self.hit = None
+            return (value,)
+        path = None
+        if dynprompt is not None:
+            paths = prompt_state(dynprompt).setdefault("disk_cache_paths", {})
+            # Not there if the value was available before the cache was checked (e.g. it was already cached upstream)
+            path = paths.pop(unique_id) if unique_id in paths else self.cache_path(namespace, dynprompt, unique_id)
+        if path is not None and DISK_CACHE_MB > 0:
+            try:
+                save_values(path, value)
+                evict_cache_entries(os.path.dirname(path), DISK_CACHE_MB * 1024 * 1024)
+            except TypeError as e:
+                print("Not caching the value at %s: %s" % (describe_node(dynprompt, unique_id), e))
+        return (value,)
+
 FLOW_CONTROL_NODE_CLASS_MAPPINGS = {
     "WhileLoopOpen": WhileLoopOpen,
     "WhileLoopClose": WhileLoopClose,
     "ExecutionBlocker": ExecutionBlockerNode,
+    "BatchLoopOpen": BatchLoopOpen,
+    "BatchLoopClose": BatchLoopClose,
+    "SweepOpen": SweepOpen,
+    "SweepClose": SweepClose,
+    "SweepGather": SweepGather,
+    "DiskCache": DiskCacheNode,
 }
 FLOW_CONTROL_NODE_DISPLAY_NAME_MAPPINGS = {
     "WhileLoopOpen": "While Loop Open",
     "WhileLoopClose": "While Loop Close",
     "ExecutionBlocker": "Execution Blocker",
+    "BatchLoopOpen": "Batch Loop Open",
+    "BatchLoopClose": "Batch Loop Close",
+    "SweepOpen": "Sweep Open",
+    "SweepClose": "Sweep Close",
+    "SweepGather": "Sweep Gather",
+    "DiskCache": "Disk Cache",
 }
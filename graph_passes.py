@@ -0,0 +1,436 @@
+import copy
+from comfy_execution.graph_utils import is_link, GraphBuilder
+from .tools import prompt_state, setting, describe_node
+from .tracing import span
+from .memory import memory_ledger
+
+# Passes that simplify a prompt before it is validated and scheduled (and the graphs our nodes expand into).
+# They only ever rewrite nodes from this pack, and only in ways that can't change the result of the prompt.
+
+# Nodes without side effects that are evaluated ahead of time when all of their inputs are constants. This runs
+# while the server handles the request that queues the prompt, so only operations that are always cheap qualify
+# (not regex matches, and not integer powers -- see UNFOLDABLE_OPERATIONS).
+FOLDABLE_NODES = ("IntMathOperation", "IntConditions", "FloatConditions", "StringConditions", "BoolOperationNode")
+UNFOLDABLE_OPERATIONS = ("power", "a MATCH REGEX(b)")
+
+# Core nodes whose outputs only depend on their inputs, so duplicates of them can be merged. Nodes of this pack opt
+# in with a PURE = True class attribute instead.
+PURE_NODES = (
+    "CheckpointLoaderSimple",
+    "CLIPTextEncode",
+    "ConditioningCombine",
+    "EmptyLatentImage",
+    "LoraLoader",
+    "VAEDecode",
+    "VAEEncode",
+)
+
+# Limits on what the expansions made by this pack may add to a single prompt, so that a runaway loop fails
+# quickly instead of taking the server down. 0 disables a limit. The total number of expanded nodes grows with
+# every iteration of every loop in the prompt, so it is off unless set.
+MAX_EXPANDED_NODES = setting("max_expanded_nodes", 0)
+MAX_EXPANSION_DEPTH = setting("max_expansion_depth", 64)
+
+def choose_branch(class_type, inputs):
+    """Returns the input a switch will pass through, if its choice is fixed by constant inputs"""
+    if class_type == "InversionDemoLazySwitch":
+        switch = inputs.get("switch", None)
+        if not isinstance(switch, (bool, int)):
+            return None
+        return "on_true" if switch else "on_false"
+    elif class_type == "InversionDemoLazyIndexSwitch":
+        index = inputs.get("index", None)
+        if not isinstance(index, int) or isinstance(index, bool):
+            return None
+        return "value%d" % index
+    elif class_type == "InversionDemoLazyConditional":
+        from .nodes import NUM_IF_ELSE_NODES
+        for i in range(1, NUM_IF_ELSE_NODES + 1):
+            condition = inputs.get("condition%d" % i, None)
+            if is_link(condition) or not isinstance(condition, (bool, int)):
+                # Only known at runtime
+                return None
+            if condition:
+                return "value%d" % i
+        return "else"
+    elif class_type == "ExecutionBlocker":
+        block = inputs.get("block", None)
+        if not isinstance(block, (bool, int)) or block:
+            return None
+        return "input"
+    return None
+
+def declared_input_spec(class_type, key):
+    import nodes
+    class_def = nodes.NODE_CLASS_MAPPINGS.get(class_type, None)
+    if class_def is None:
+        return None
+    input_types = class_def.INPUT_TYPES()
+    for category in ("required", "optional"):
+        if key in input_types.get(category, {}):
+            return input_types[category][key]
+    return None
+
+def output_type(class_type, index):
+    import nodes
+    class_def = nodes.NODE_CLASS_MAPPINGS.get(class_type, None)
+    return_types = getattr(class_def, "RETURN_TYPES", ())
+    return return_types[index] if index < len(return_types) else None
+
+def literal_matches(value, input_type):
+    type_name = input_type[0]
+    options = input_type[1] if len(input_type) > 1 else {}
+    if isinstance(type_name, list):
+        return isinstance(value, str) and value in type_name
+    if type_name == "INT":
+        valid = isinstance(value, int) and not isinstance(value, bool)
+    elif type_name == "FLOAT":
+        valid = isinstance(value, (int, float)) and not isinstance(value, bool)
+    elif type_name == "BOOLEAN":
+        valid = isinstance(value, bool)
+    elif type_name == "STRING":
+        valid = isinstance(value, str)
+    else:
+        return False
+    if not valid:
+        return False
+    return options.get("min", value) <= value <= options.get("max", value)
+
+def can_rewire(prompt, consumer, key, value):
+    """Whether a consumer of a switch's output would still validate if given value directly. The switch outputs
+    "*", which matches anything, but what it passes through may not. Literals are checked against the whole input
+    spec (including min, max and combo options), which the validator only applies to literals and not to links."""
+    spec = declared_input_spec(consumer["class_type"], key)
+    if spec is None:
+        return False
+    expected = spec[0]
+    if expected == "*":
+        return True
+    if not is_link(value):
+        return literal_matches(value, spec)
+    if value[0] not in prompt:
+        return False
+    received = output_type(prompt[value[0]].get("class_type", None), value[1])
+    if received is None or not isinstance(expected, str) or not isinstance(received, str):
+        return received is not None and received == expected
+    if received == "*":
+        return True
+    return set(t.strip() for t in received.split(",")).issubset(set(t.strip() for t in expected.split(",")))
+
+def is_output_node(class_type):
+    import nodes
+    class_def = nodes.NODE_CLASS_MAPPINGS.get(class_type, None)
+    # Unknown classes will fail validation anyway, so we don't want to be the ones to remove them
+    return class_def is None or getattr(class_def, "OUTPUT_NODE", False)
+
+def reachable_nodes(prompt, output_ids):
+    reachable = set()
+    to_visit = list(output_ids)
+    while len(to_visit) > 0:
+        node_id = to_visit.pop()
+        if node_id in reachable or node_id not in prompt:
+            continue
+        reachable.add(node_id)
+        for value in prompt[node_id].get("inputs", {}).values():
+            if is_link(value):
+                to_visit.append(value[0])
+    return reachable
+
+def find_consumers(graph):
+    consumers = {}
+    for node_id, node in graph.items():
+        for key, value in node.get("inputs", {}).items():
+            if is_link(value):
+                consumers.setdefault(value[0], []).append((node_id, key))
+    return consumers
+
+def evaluate_constant(node):
+    """Returns the outputs of node if it can be evaluated from its literal inputs alone, otherwise None"""
+    class_type = node.get("class_type", None)
+    if class_type not in FOLDABLE_NODES:
+        return None
+    import nodes
+    class_def = nodes.NODE_CLASS_MAPPINGS.get(class_type, None)
+    if class_def is None:
+        return None
+    input_types = class_def.INPUT_TYPES()
+    declared = dict(input_types.get("optional", {}))
+    declared.update(input_types.get("required", {}))
+    inputs = node.get("inputs", {})
+    kwargs = {}
+    for key, input_type in declared.items():
+        if key not in inputs:
+            if key in input_types.get("required", {}):
+                return None
+            continue
+        value = inputs[key]
+        # Anything the validator would reject (or convert) is left for it to handle
+        if is_link(value) or not literal_matches(value, input_type):
+            return None
+        kwargs[key] = float(value) if input_type[0] == "FLOAT" else value
+    if kwargs.get("operation", None) in UNFOLDABLE_OPERATIONS:
+        return None
+    try:
+        outputs = getattr(class_def(), class_def.FUNCTION)(**kwargs)
+    except Exception:
+        # e.g. division by zero. The error should come from the node when it runs.
+        return None
+    if not isinstance(outputs, tuple) or not all(isinstance(x, (bool, int, float, str)) for x in outputs):
+        return None
+    return outputs
+
+def fold_constants(graph, results=None):
+    """Evaluates foldable nodes whose inputs are all literals and replaces links to them with their outputs (in
+    results too, if given). Folded nodes that nothing links to any more are removed from the graph."""
+    consumers = find_consumers(graph)
+    folded = set()
+    changed = False
+    to_visit = list(graph.keys())
+    while len(to_visit) > 0:
+        node_id = to_visit.pop()
+        if node_id in folded or node_id not in graph:
+            continue
+        outputs = evaluate_constant(graph[node_id])
+        if outputs is None:
+            continue
+        folded.add(node_id)
+        for consumer_id, key in consumers.get(node_id, []):
+            value = graph[consumer_id]["inputs"].get(key, None)
+            # A link the validator would reject (e.g. INT into FLOAT) has to stay a link for it to be rejected, and
+            # so does a value it only accepts through a link (min and max are only checked on literals)
+            if (is_link(value) and value[0] == node_id and value[1] < len(outputs)
+                    and can_rewire(graph, graph[consumer_id], key, value)
+                    and can_rewire(graph, graph[consumer_id], key, outputs[value[1]])):
+                graph[consumer_id]["inputs"][key] = outputs[value[1]]
+                to_visit.append(consumer_id)
+                changed = True
+        if results is not None:
+            for i, value in enumerate(results):
+                if is_link(value) and value[0] == node_id and value[1] < len(outputs):
+                    results[i] = outputs[value[1]]
+                    changed = True
+
+    linked = set()
+    for node in graph.values():
+        for value in node.get("inputs", {}).values():
+            if is_link(value):
+                linked.add(value[0])
+    for value in results or []:
+        if is_link(value):
+            linked.add(value[0])
+    for node_id in folded - linked:
+        del graph[node_id]
+        changed = True
+    return changed
+
+def cse_eligible(class_type, eligibility):
+    """Whether two nodes of this class with the same inputs are guaranteed to produce the same outputs. Only
+    classes that say so are trusted: this pack's pure nodes set PURE = True, and a few core nodes are listed in
+    PURE_NODES. Anything else may have side effects (printing, saving, randomness) that merging would lose."""
+    if class_type in eligibility:
+        return eligibility[class_type]
+    import nodes
+    class_def = nodes.NODE_CLASS_MAPPINGS.get(class_type, None)
+    eligible = class_def is not None and (class_type in PURE_NODES or getattr(class_def, "PURE", False))
+    eligibility[class_type] = eligible
+    return eligible
+
+def node_signature(node, aliases):
+    """Returns a hashable description of a node's class and immediate inputs, or None if it has unhashable inputs"""
+    inputs = []
+    for key, value in node.get("inputs", {}).items():
+        if is_link(value):
+            inputs.append((key, "link", aliases.get(value[0], value[0]), value[1]))
+        elif value is None or isinstance(value, (bool, int, float, str)):
+            # The type is included so that e.g. True and 1 aren't treated as the same input
+            inputs.append((key, type(value).__name__, value))
+        else:
+            return None
+    return (node["class_type"], tuple(sorted(inputs)))
+
+def topological_order(graph):
+    order = []
+    visited = set()
+    for start in graph:
+        stack = [(start, False)]
+        while len(stack) > 0:
+            node_id, expanded = stack.pop()
+            if expanded:
+                order.append(node_id)
+                continue
+            if node_id in visited:
+                continue
+            visited.add(node_id)
+            stack.append((node_id, True))
+            for value in graph[node_id].get("inputs", {}).values():
+                if is_link(value) and value[0] in graph and value[0] not in visited:
+                    stack.append((value[0], False))
+    return order
+
+def eliminate_common_subexpressions(graph, results, dynprompt):
+    """Removes nodes from graph that are identical to a node already in the prompt (or earlier in graph) and
+    links their consumers and results to that node instead"""
+    state = prompt_state(dynprompt)
+    eligibility = state.setdefault("cse_eligibility", {})
+    index = state.get("cse_index", None)
+    # The signature each indexed node is listed under, so that its entry can be removed when it is released
+    signatures = state.setdefault("cse_signatures", {})
+    if index is None:
+        index = {}
+        for node_id in dynprompt.all_node_ids():
+            node = dynprompt.get_node(node_id)
+            if cse_eligible(node["class_type"], eligibility):
+                signature = node_signature(node, {})
+                if signature is not None and signature not in index:
+                    index[signature] = node_id
+                    signatures[node_id] = signature
+        state["cse_index"] = index
+
+    aliases = {}
+    for node_id in topological_order(graph):
+        node = graph[node_id]
+        for key, value in node.get("inputs", {}).items():
+            if is_link(value) and value[0] in aliases:
+                node["inputs"][key] = [aliases[value[0]], value[1]]
+        if not cse_eligible(node["class_type"], eligibility):
+            continue
+        signature = node_signature(node, aliases)
+        if signature is None:
+            continue
+        existing = index.get(signature, None)
+        # Nodes from earlier loop iterations are released from the prompt, so the entry may be stale
+        if existing is not None and existing != node_id and (existing in graph or dynprompt.has_node(existing)):
+            aliases[node_id] = existing
+            del graph[node_id]
+        else:
+            if existing is not None:
+                signatures.pop(existing, None)
+            index[signature] = node_id
+            signatures[node_id] = signature
+    for i, value in enumerate(results):
+        if is_link(value) and value[0] in aliases:
+            results[i] = [aliases[value[0]], value[1]]
+
+def forget_common_subexpression(dynprompt, node_id):
+    """Removes a node that is being released from the prompt from the index of nodes that others can be merged
+    into, so the index doesn't grow with every iteration of a loop"""
+    state = prompt_state(dynprompt)
+    signature = state.get("cse_signatures", {}).pop(node_id, None)
+    index = state.get("cse_index", None)
+    if signature is not None and index is not None and index.get(signature, None) == node_id:
+        del index[signature]
+
+def expansion_depth(dynprompt, node_id, depths):
+    """How many expansions deep node_id is. Iterations of a loop are expanded by the previous iteration, so
+    expansions by a node with the same display ID (i.e. the same loop) don't count."""
+    chain = []
+    while node_id not in depths:
+        parent_id = dynprompt.get_parent_node_id(node_id)
+        if parent_id is None:
+            depths[node_id] = 0
+            break
+        chain.append((node_id, parent_id))
+        node_id = parent_id
+    for node_id, parent_id in reversed(chain):
+        same_loop = dynprompt.get_display_node_id(node_id) == dynprompt.get_display_node_id(parent_id)
+        depths[node_id] = depths[parent_id] + (0 if same_loop else 1)
+    return depths[chain[0][0]] if len(chain) > 0 else depths[node_id]
+
+def enforce_expansion_budget(graph, dynprompt, unique_id):
+    state = prompt_state(dynprompt)
+    if MAX_EXPANSION_DEPTH > 0:
+        depth = expansion_depth(dynprompt, unique_id, state.setdefault("expansion_depths", {})) + 1
+        if depth > MAX_EXPANSION_DEPTH:
+            raise Exception("Expansion of %s is nested %d levels deep (the limit is %d, set by INVERSION_DEMO_MAX_EXPANSION_DEPTH)" % (describe_node(dynprompt, unique_id), depth, MAX_EXPANSION_DEPTH))
+    state["expanded_nodes"] = state.get("expanded_nodes", 0) + len(graph)
+    if MAX_EXPANDED_NODES > 0 and state["expanded_nodes"] > MAX_EXPANDED_NODES:
+        raise Exception("Expansion of %s brings the prompt to %d expanded nodes (the limit is %d, set by INVERSION_DEMO_MAX_EXPANDED_NODES)" % (describe_node(dynprompt, unique_id), state["expanded_nodes"], MAX_EXPANDED_NODES))
+
+def finalize_expansion(graph, result, dynprompt=None, unique_id=None):
+    """Builds the return value of an expanding node from graph (a GraphBuilder or an already finalized graph)
+    and the links or values in result, after folding any constants in the new nodes and merging nodes that
+    duplicate ones already in the prompt"""
+    with span("finalize_expansion", "expansion", node=unique_id) as s:
+        if isinstance(graph, GraphBuilder):
+            graph = graph.finalize()
+        s.set(built_nodes=len(graph))
+        result = list(result)
+        fold_constants(graph, result)
+        if dynprompt is not None:
+            eliminate_common_subexpressions(graph, result, dynprompt)
+            if unique_id is not None:
+                enforce_expansion_budget(graph, dynprompt, unique_id)
+                # So that releasing a node can release what it expanded into as well
+                prompt_state(dynprompt).setdefault("expansion_children", {}).setdefault(unique_id, []).extend(graph.keys())
+                ledger = memory_ledger(dynprompt)
+                if ledger is not None:
+                    # Literal inputs are what an expansion holds on to, e.g. the values carried into a loop iteration
+                    ledger.record("expansions by %s" % dynprompt.get_display_node_id(unique_id), [node["inputs"] for node in graph.values()], None)
+        s.set(expanded_nodes=len(graph))
+    return {
+        "result": tuple(result),
+        "expand": graph,
+    }
+
+def resolve_constant_switches(prompt):
+    """Resolves lazy switches whose choice is fixed by widget values by wiring their consumers straight to the
+    chosen input. The switches themselves are left alone, and are removed once nothing needs them."""
+    consumers = find_consumers(prompt)
+    changed = False
+    for node_id, node in prompt.items():
+        inputs = node.get("inputs", {})
+        chosen = choose_branch(node.get("class_type", None), inputs)
+        if chosen is None or chosen not in inputs:
+            # If the node will ask for an input that isn't connected, let it fail the way it always has
+            continue
+        value = inputs[chosen]
+        remaining = []
+        for consumer_id, key in consumers.get(node_id, []):
+            consumer = prompt[consumer_id]
+            consumer_inputs = consumer["inputs"]
+            if not (is_link(consumer_inputs.get(key, None)) and consumer_inputs[key][0] == node_id):
+                continue
+            if not can_rewire(prompt, consumer, key, value):
+                remaining.append((consumer_id, key))
+                continue
+            consumer_inputs[key] = copy.copy(value)
+            if is_link(value):
+                consumers.setdefault(value[0], []).append((consumer_id, key))
+            changed = True
+        consumers[node_id] = remaining
+    return changed
+
+def simplify_prompt(prompt):
+    """Folds constants and resolves constant switches until neither finds anything more to do, then removes the
+    nodes that are no longer needed by any output"""
+    output_ids = [node_id for node_id, node in prompt.items() if is_output_node(node.get("class_type", None))]
+    before = reachable_nodes(prompt, output_ids)
+    changed = False
+    while True:
+        # Folding can turn a switch's selector into a literal and resolving a switch can hand literals to nodes
+        # that can then be folded
+        step_changed = fold_constants(prompt)
+        step_changed = resolve_constant_switches(prompt) or step_changed
+        if not step_changed:
+            break
+        changed = True
+
+    if changed:
+        after = reachable_nodes(prompt, output_ids)
+        for node_id in before - after:
+            if node_id in prompt:
+                del prompt[node_id]
+    return prompt
+
+def on_prompt(json_data):
+    if "prompt" in json_data:
+        simplify_prompt(json_data["prompt"])
+    return json_data
+
+def setup_prompt_handlers():
+    try:
+        from server import PromptServer
+    except ImportError:
+        return
+    if PromptServer.instance is not None:
+        PromptServer.instance.add_on_prompt_handler(on_prompt)
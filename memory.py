@@ -0,0 +1,146 @@
+import collections
+import threading
+import weakref
+import torch
+from .tools import setting, prompt_state
+
+# Set INVERSION_DEMO_MEMORY_REPORT=1 to account for the tensor memory referenced by accumulations, by the values
+# carried through loops and by the literal inputs of each expansion. Tensors that share storage are only counted
+# once. A prompt's report is printed when its state is released (once the executor lets go of the prompt, at the
+# latest when the next one starts), and recent reports can be read from /inversion_demo/memory.
+MEMORY_REPORT = setting("memory_report", False)
+
+# Number of holders listed in a report
+MEMORY_REPORT_TOP = setting("memory_report_top", 10)
+
+# Number of prompts whose reports are kept for the HTTP route
+MEMORY_REPORT_HISTORY = 8
+
+def tensor_storages(value, storages):
+    """Collects the storages referenced by a value as {(device, data pointer): bytes}"""
+    if isinstance(value, torch.Tensor):
+        storage = value.untyped_storage()
+        storages[(str(value.device), storage.data_ptr())] = storage.nbytes()
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            tensor_storages(item, storages)
+    elif isinstance(value, dict):
+        for item in value.values():
+            tensor_storages(item, storages)
+    return storages
+
+class MemoryLedger:
+    """Tracks the storages currently referenced by each holder (only their addresses and sizes, never the
+    tensors themselves) along with the peak of each holder and of all of them together"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.holders = {}
+        self.references = collections.Counter()
+        self.sizes = {}
+        self.total = 0
+        self.peak_total = 0
+        self.peak_holder = None
+
+    def record(self, holder, value, iteration, append=False):
+        """Records the storages referenced by value as those the holder references now, or with append as
+        referenced in addition to those it already did (e.g. when an item is added to an accumulation)"""
+        storages = tensor_storages(value, {})
+        with self.lock:
+            entry = self.holders.get(holder, None)
+            if entry is None:
+                entry = {"storages": {}, "bytes": 0, "peak": 0, "peak_iteration": None, "updates": 0}
+                self.holders[holder] = entry
+            if iteration is None:
+                # e.g. expansions, which are counted by generation
+                iteration = entry["updates"]
+            if not append:
+                for key in entry["storages"]:
+                    self.references[key] -= 1
+                    if self.references[key] == 0:
+                        del self.references[key]
+                        self.total -= self.sizes.pop(key)
+                entry["storages"] = {}
+                entry["bytes"] = 0
+            for key, nbytes in storages.items():
+                if key in entry["storages"]:
+                    continue
+                if self.references[key] == 0:
+                    self.sizes[key] = nbytes
+                    self.total += nbytes
+                self.references[key] += 1
+                entry["storages"][key] = nbytes
+                entry["bytes"] += nbytes
+            entry["updates"] += 1
+            if entry["bytes"] >= entry["peak"]:
+                entry["peak"] = entry["bytes"]
+                entry["peak_iteration"] = iteration
+            if self.total > self.peak_total:
+                self.peak_total = self.total
+                self.peak_holder = (holder, iteration)
+
+    def report(self):
+        with self.lock:
+            holders = sorted(self.holders.items(), key=lambda item: item[1]["peak"], reverse=True)
+            return {
+                "total_bytes": self.total,
+                "peak_total_bytes": self.peak_total,
+                "peak_reached_at": {"holder": self.peak_holder[0], "iteration": self.peak_holder[1]} if self.peak_holder is not None else None,
+                "holders": [{
+                    "holder": holder,
+                    "bytes": entry["bytes"],
+                    "peak_bytes": entry["peak"],
+                    "peak_iteration": entry["peak_iteration"],
+                    "updates": entry["updates"],
+                } for holder, entry in holders[:MEMORY_REPORT_TOP]],
+            }
+
+def format_report(report):
+    mb = 1024 * 1024
+    lines = ["Memory report: %.1f MB referenced at the end, peak %.1f MB" % (report["total_bytes"] / mb, report["peak_total_bytes"] / mb)]
+    if report["peak_reached_at"] is not None:
+        lines[0] += " (reached when %s was at iteration %s)" % (report["peak_reached_at"]["holder"], report["peak_reached_at"]["iteration"])
+    for holder in report["holders"]:
+        lines.append("  %-48s %10.1f MB now, peak %10.1f MB at iteration %s" % (holder["holder"], holder["bytes"] / mb, holder["peak_bytes"] / mb, holder["peak_iteration"]))
+    return "\n".join(lines)
+
+_recent_ledgers = collections.deque(maxlen=MEMORY_REPORT_HISTORY)
+
+def print_report(ledger):
+    if len(ledger.holders) > 0:
+        print(format_report(ledger.report()))
+
+def memory_ledger(dynprompt):
+    """Returns the ledger for a prompt, or None if memory accounting is disabled"""
+    if not MEMORY_REPORT or dynprompt is None:
+        return None
+    state = prompt_state(dynprompt)
+    ledger = state.get("memory_ledger", None)
+    if ledger is None:
+        ledger = MemoryLedger()
+        state["memory_ledger"] = ledger
+        _recent_ledgers.append(ledger)
+        # The prompt's state (and with it the ledger) lives exactly as long as the prompt, after which the report
+        # is complete
+        weakref.finalize(dynprompt, print_report, ledger)
+    return ledger
+
+def record_memory(dynprompt, holder, value, iteration=None, append=False):
+    ledger = memory_ledger(dynprompt)
+    if ledger is not None:
+        ledger.record(holder, value, iteration, append)
+
+def setup_memory_routes():
+    if not MEMORY_REPORT:
+        return
+    try:
+        from server import PromptServer
+        from aiohttp import web
+    except ImportError:
+        return
+    if PromptServer.instance is None:
+        return
+
+    @PromptServer.instance.routes.get("/inversion_demo/memory")
+    async def get_memory_reports(request):
+        # Most recent prompt first
+        return web.json_response([ledger.report() for ledger in reversed(_recent_ledgers)])
@@ -1,7 +1,10 @@
 import re
+import weakref
+import torch
 
-from comfy_execution.graph_utils import GraphBuilder
-from .tools import VariantSupport
+from .tools import VariantSupport, setting
+from .expansion import expansion_graph
+from .graph_passes import finalize_expansion
 
 @VariantSupport()
 class InversionDemoAdvancedPromptNode:
@@ -16,6 +19,10 @@ class InversionDemoAdvancedPromptNode:
                 "model": ("MODEL",),
                 "clip": ("CLIP",),
             },
+            "hidden": {
+                "dynprompt": "DYNPROMPT",
+                "unique_id": "UNIQUE_ID",
+            },
         }
 
     RETURN_TYPES = ("MODEL", "CLIP", "CONDITIONING")
@@ -62,8 +69,8 @@ class InversionDemoAdvancedPromptNode:
         return cleaned_prompt, loras
 
 
-    def advanced_prompt(self, prompt, clip, model):
-        graph = GraphBuilder()
+    def advanced_prompt(self, prompt, clip, model, dynprompt=None, unique_id=None):
+        graph = expansion_graph(unique_id)
         cleaned_prompt, loras = self.parse_loras(prompt)
         for lora in loras:
             lora_name = lora[0]
@@ -84,10 +91,7 @@ class InversionDemoAdvancedPromptNode:
             else:
                 prev_output = graph.node("ConditioningCombine", conditioning_1=prev_output, conditioning_2=ranger.out(0)).out(0)
 
-        return {
-            "result": (model, clip, prev_output),
-            "expand": graph.finalize(),
-        }
+        return finalize_expansion(graph, (model, clip, prev_output), dynprompt, unique_id)
 
 @VariantSupport()
 class InversionDemoLazySwitch:
@@ -119,7 +123,11 @@ class InversionDemoLazySwitch:
         value = on_true if switch else on_false
         return (value,)
 
-NUM_IF_ELSE_NODES = 10
+# Can be raised with the INVERSION_DEMO_NUM_IF_ELSE_NODES environment variable
+NUM_IF_ELSE_NODES = max(1, setting("num_if_else_nodes", 10))
+CONDITION_KEYS = ["condition%d" % (i + 1) for i in range(NUM_IF_ELSE_NODES)]
+VALUE_KEYS = ["value%d" % (i + 1) for i in range(NUM_IF_ELSE_NODES)]
+
 @VariantSupport()
 class InversionDemoLazyConditional:
     def __init__(self):
@@ -133,14 +141,21 @@ class InversionDemoLazyConditional:
         }
 
         for i in range(1,NUM_IF_ELSE_NODES):
-            args["value%d" % (i + 1)] = ("*", {"lazy": True})
-            args["condition%d" % (i + 1)] = ("BOOLEAN", {"lazy": True, "forceInput": True})
+            args[VALUE_KEYS[i]] = ("*", {"lazy": True})
+            args[CONDITION_KEYS[i]] = ("BOOLEAN", {"lazy": True, "forceInput": True})
 
         args["else"] = ("*", {"lazy": True})
+        # Requests every connected condition in one round instead of one at a time. Better when the conditions are
+        # cheap, since conditions after the first true one get evaluated for nothing.
+        args["eager_conditions"] = ("BOOLEAN", {"default": False})
 
         return {
             "required": {},
             "optional": args,
+            "hidden": {
+                "dynprompt": "DYNPROMPT",
+                "unique_id": "UNIQUE_ID",
+            },
         }
 
     RETURN_TYPES = ("*",)
@@ -148,13 +163,30 @@ class InversionDemoLazyConditional:
 
     CATEGORY = "InversionDemo Nodes/Logic"
 
-    def check_lazy_status(self, **kwargs):
+    def check_lazy_status(self, eager_conditions=False, dynprompt=None, unique_id=None, **kwargs):
+        if eager_conditions and dynprompt is not None:
+            # Unevaluated lazy inputs are passed as None, so we need the prompt to tell them apart from ones that
+            # aren't connected at all
+            inputs = dynprompt.get_node(unique_id)["inputs"]
+            pending = [cond for cond in CONDITION_KEYS if kwargs.get(cond, None) is None and cond in inputs]
+            if len(pending) > 0:
+                return pending
+            for i in range(0,NUM_IF_ELSE_NODES):
+                cond = CONDITION_KEYS[i]
+                if cond not in inputs:
+                    # Not connected, so it can't be true
+                    continue
+                if kwargs[cond]:
+                    val = VALUE_KEYS[i]
+                    return [val] if kwargs.get(val, None) is None and val in inputs else []
+            return ["else"] if kwargs.get("else", None) is None and "else" in inputs else []
+
         for i in range(0,NUM_IF_ELSE_NODES):
-            cond = "condition%d" % (i + 1)
+            cond = CONDITION_KEYS[i]
             if cond not in kwargs:
                 return [cond]
             if kwargs[cond]:
-                val = "value%d" % (i + 1)
+                val = VALUE_KEYS[i]
                 if val not in kwargs:
                     return [val]
                 else:
@@ -163,13 +195,16 @@ class InversionDemoLazyConditional:
         if "else" not in kwargs:
             return ["else"]
 
-    def conditional(self, **kwargs):
+    def conditional(self, eager_conditions=False, dynprompt=None, unique_id=None, **kwargs):
         for i in range(0,NUM_IF_ELSE_NODES):
-            cond = "condition%d" % (i + 1)
+            cond = CONDITION_KEYS[i]
             if cond not in kwargs:
+                if eager_conditions:
+                    # check_lazy_status skipped it, since it isn't connected
+                    continue
                 return [cond]
             if kwargs.get(cond, False):
-                val = "value%d" % (i + 1)
+                val = VALUE_KEYS[i]
                 return (kwargs.get(val, None),)
 
         return (kwargs.get("else", None),)
@@ -214,10 +249,24 @@ class InversionDemoLazyIndexSwitch:
         key = "value%d" % index
         return (kwargs[key],)
 
+def batch_slice(tensor, start, end, batch_size):
+    # Batches of one are left for broadcasting to handle, and other sizes are repeated to fill the batch. Only the
+    # requested part of the batch is ever copied.
+    if tensor.shape[0] == 1:
+        return tensor
+    if tensor.shape[0] == batch_size:
+        return tensor[start:end]
+    return tensor[torch.arange(start, end, device=tensor.device) % tensor.shape[0]]
+
+def row_slice(tensor, rows):
+    if tensor.shape[1] == 1:
+        return tensor
+    return tensor[:, rows]
+
 @VariantSupport()
 class InversionDemoLazyMixImages:
     def __init__(self):
-        pass
+        self.mask_range_cache = None
 
     @classmethod
     def INPUT_TYPES(cls):
@@ -227,6 +276,9 @@ class InversionDemoLazyMixImages:
                 "image2": ("IMAGE",{"lazy": True}),
                 "mask": ("MASK",),
             },
+            "optional": {
+                "memory_budget_mb": ("INT", {"default": 0, "min": 0, "max": 1000000, "step": 1}),
+            },
         }
 
     RETURN_TYPES = ("IMAGE",)
@@ -234,9 +286,17 @@ class InversionDemoLazyMixImages:
 
     CATEGORY = "InversionDemo Nodes/Demo"
 
-    def check_lazy_status(self, mask, image1 = None, image2 = None):
-        mask_min = mask.min()
-        mask_max = mask.max()
+    def mask_range(self, mask):
+        # check_lazy_status and mix are called on the same instance with the same mask, so we only need to
+        # reduce it once. aminmax finds both values in a single pass and tolist() syncs with the device once.
+        if self.mask_range_cache is not None and self.mask_range_cache[0]() is mask:
+            return self.mask_range_cache[1]
+        mask_min, mask_max = torch.stack(torch.aminmax(mask)).tolist()
+        self.mask_range_cache = (weakref.ref(mask), (mask_min, mask_max))
+        return mask_min, mask_max
+
+    def check_lazy_status(self, mask, image1 = None, image2 = None, memory_budget_mb = 0):
+        mask_min, mask_max = self.mask_range(mask)
         needed = []
         if image1 is None and (mask_min != 1.0 or mask_max != 1.0):
             needed.append("image1")
@@ -244,10 +304,8 @@ class InversionDemoLazyMixImages:
             needed.append("image2")
         return needed
 
-    # Not trying to handle different batch sizes here just to keep the demo simple
-    def mix(self, mask, image1 = None, image2 = None):
-        mask_min = mask.min()
-        mask_max = mask.max()
+    def mix(self, mask, image1 = None, image2 = None, memory_budget_mb = 0):
+        mask_min, mask_max = self.mask_range(mask)
         if mask_min == 0.0 and mask_max == 0.0:
             return (image1,)
         elif mask_min == 1.0 and mask_max == 1.0:
@@ -257,10 +315,34 @@ class InversionDemoLazyMixImages:
             mask = mask.unsqueeze(0)
         if len(mask.shape) == 3:
             mask = mask.unsqueeze(3)
-        if mask.shape[3] < image1.shape[3]:
-            mask = mask.repeat(1, 1, 1, image1.shape[3])
 
-        return (image1 * (1. - mask) + image2 * mask,)
+        batch_size = max(image1.shape[0], image2.shape[0], mask.shape[0])
+        frame_shape = torch.broadcast_shapes(image1.shape[1:], image2.shape[1:], mask.shape[1:])
+        output = torch.empty((batch_size,) + tuple(frame_shape), dtype=image1.dtype, device=image1.device)
+
+        # With a budget, we blend a few frames (or, for very large frames, a few rows) at a time. Each chunk may
+        # need up to three temporaries of its own size for repeating batches and converting dtypes. Every chunk
+        # uses the same elementwise kernel, so the result is identical to blending everything at once.
+        frames_per_chunk = batch_size
+        rows_per_chunk = frame_shape[0]
+        if memory_budget_mb > 0:
+            budget = memory_budget_mb * 1024 * 1024
+            frame_bytes = 3 * output[0].nelement() * output.element_size()
+            frames_per_chunk = max(1, budget // frame_bytes)
+            if frame_bytes > budget:
+                rows_per_chunk = max(1, budget // (frame_bytes // frame_shape[0]))
+
+        # The mask broadcasts across channels, and lerp blends in a single kernel without any intermediate tensors
+        for start in range(0, batch_size, frames_per_chunk):
+            end = min(start + frames_per_chunk, batch_size)
+            for row in range(0, frame_shape[0], rows_per_chunk):
+                rows = slice(row, row + rows_per_chunk)
+                torch.lerp(
+                    row_slice(batch_slice(image1, start, end, batch_size), rows),
+                    row_slice(batch_slice(image2, start, end, batch_size), rows).to(output.dtype),
+                    row_slice(batch_slice(mask, start, end, batch_size), rows).to(output.dtype),
+                    out=output[start:end, rows])
+        return (output,)
 
 GENERAL_NODE_CLASS_MAPPINGS = {
     "InversionDemoAdvancedPromptNode": InversionDemoAdvancedPromptNode,
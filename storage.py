@@ -0,0 +1,103 @@
+import json
+import os
+import torch
+import folder_paths
+import safetensors
+import safetensors.torch
+
+# Values are written as a JSON description plus a safetensors file holding every tensor they contain. The JSON
+# file is replaced last, so a reader only ever sees complete pairs even if we're interrupted mid-write.
+
+def storage_directory(kind):
+    path = os.path.join(folder_paths.get_user_directory(), "inversion_demo", kind)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def _encode(value, tensors):
+    if isinstance(value, torch.Tensor):
+        name = "t%d" % len(tensors)
+        tensors[name] = value.detach().to("cpu", copy=True).contiguous()
+        return {"__tensor__": name}
+    elif value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    elif isinstance(value, list):
+        return [_encode(item, tensors) for item in value]
+    elif isinstance(value, tuple):
+        return {"__tuple__": [_encode(item, tensors) for item in value]}
+    elif isinstance(value, dict) and all(isinstance(key, str) for key in value.keys()):
+        return {"__dict__": {key: _encode(item, tensors) for key, item in value.items()}}
+    raise TypeError("Can't store a value of type %s" % type(value).__name__)
+
+def _decode(value, tensors):
+    if isinstance(value, list):
+        return [_decode(item, tensors) for item in value]
+    elif isinstance(value, dict):
+        if "__tensor__" in value:
+            return tensors[value["__tensor__"]]
+        elif "__tuple__" in value:
+            return tuple(_decode(item, tensors) for item in value["__tuple__"])
+        return {key: _decode(item, tensors) for key, item in value["__dict__"].items()}
+    return value
+
+def save_values(path, value, metadata=None):
+    """Stores value (tensors, scalars, strings and lists/tuples/dicts of them) at path, which gets a .json and a
+    .safetensors file. Raises TypeError for anything else."""
+    tensors = {}
+    description = _encode(value, tensors)
+    previous = read_description(path)
+    tensor_file = None
+    if len(tensors) > 0:
+        # A new name for every write, so the old pair stays intact until the new description replaces it
+        serial = previous["serial"] + 1 if previous is not None else 0
+        tensor_file = "%s.%d.safetensors" % (os.path.basename(path), serial)
+        safetensors.torch.save_file(tensors, os.path.join(os.path.dirname(path), tensor_file))
+    with open(path + ".json.tmp", "w", encoding="utf-8") as f:
+        json.dump({
+            "serial": previous["serial"] + 1 if previous is not None else 0,
+            "tensors": tensor_file,
+            "value": description,
+            "metadata": metadata,
+        }, f)
+    os.replace(path + ".json.tmp", path + ".json")
+    if previous is not None and previous["tensors"] is not None and previous["tensors"] != tensor_file:
+        _remove(os.path.join(os.path.dirname(path), previous["tensors"]))
+
+def read_description(path):
+    try:
+        with open(path + ".json", "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+class _TensorFile:
+    # Reads each tensor from the file as the description asks for it, rather than the whole file up front
+    def __init__(self, f):
+        self.f = f
+
+    def __getitem__(self, name):
+        return self.f.get_tensor(name)
+
+def load_values(path):
+    """Returns (value, metadata) stored at path, or None if nothing (readable) is stored there"""
+    description = read_description(path)
+    if description is None:
+        return None
+    if description["tensors"] is None:
+        return _decode(description["value"], {}), description["metadata"]
+    try:
+        with safetensors.safe_open(os.path.join(os.path.dirname(path), description["tensors"]), framework="pt") as f:
+            return _decode(description["value"], _TensorFile(f)), description["metadata"]
+    except Exception:
+        return None
+
+def delete_values(path):
+    description = read_description(path)
+    _remove(path + ".json")
+    if description is not None and description["tensors"] is not None:
+        _remove(os.path.join(os.path.dirname(path), description["tensors"]))
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
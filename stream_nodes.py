@@ -0,0 +1,141 @@
+import json
+import os
+import numpy as np
+import torch
+import folder_paths
+from PIL import Image
+from .tools import VariantSupport, loop_node_state
+
+# .npy streams are written with a header of this fixed size, so the shape can be rewritten in place after every
+# append without moving the data that follows it
+NPY_HEADER_SIZE = 256
+
+def stream_tensor(value):
+    if isinstance(value, dict) and "samples" in value:
+        value = value["samples"]
+    if isinstance(value, torch.Tensor):
+        return value.detach().cpu()
+    return None
+
+def npy_header(dtype, shape):
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (np.lib.format.dtype_to_descr(dtype), tuple(shape))
+    # Magic string (6 bytes), version (2 bytes) and header length (2 bytes) come before the header
+    padding = NPY_HEADER_SIZE - 10 - len(header) - 1
+    if padding < 0:
+        raise Exception("Shape %s is too long for a .npy stream" % (tuple(shape),))
+    return b"\x93NUMPY\x01\x00" + (NPY_HEADER_SIZE - 10).to_bytes(2, "little") + (header + " " * padding + "\n").encode("latin1")
+
+def json_default(value):
+    if isinstance(value, torch.Tensor):
+        return value.tolist()
+    if isinstance(value, dict) and "accum" in value:
+        return value["accum"]
+    return repr(value)
+
+@VariantSupport()
+class StreamSinkNode:
+    """Appends every value it receives to one file per sink. Although it's an output node, it only runs once per
+    loop iteration when its count output is wired into one of the loop's sockets (so that it's part of the loop
+    body). Otherwise it runs a single time, after the loop, with whatever value reaches it then."""
+    def __init__(self):
+        pass
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "value": ("*",),
+                "format": (["png", "npy", "jsonl"],),
+                "filename_prefix": ("STRING", {"default": "stream/stream"}),
+            },
+            "hidden": {
+                "dynprompt": "DYNPROMPT",
+                "unique_id": "UNIQUE_ID",
+            },
+        }
+
+    RETURN_TYPES = ("INT",)
+    RETURN_NAMES = ("count",)
+    FUNCTION = "stream_sink"
+    OUTPUT_NODE = True
+
+    CATEGORY = "InversionDemo Nodes/Flow"
+
+    def stream_sink(self, value, format, filename_prefix, dynprompt=None, unique_id=None):
+        # All iterations of a loop write to the same stream. Wire the count into one of the loop's sockets so the
+        # sink is part of the loop body.
+        streams = loop_node_state(dynprompt, unique_id, "streams")
+        key = (format, filename_prefix)
+        stream = streams.get(key, None)
+        if stream is None:
+            output_dir = folder_paths.get_output_directory()
+            full_output_folder, filename, counter, _, _ = folder_paths.get_save_image_path(filename_prefix, output_dir)
+            os.makedirs(full_output_folder, exist_ok=True)
+            stream = {
+                "path": os.path.join(full_output_folder, "%s_%05d_" % (filename, counter)),
+                "count": 0,
+                "dtype": None,
+                "shape": None,
+            }
+            streams[key] = stream
+
+        if format == "png":
+            self.write_png(stream, value)
+        elif format == "npy":
+            self.write_npy(stream, value)
+        else:
+            self.write_jsonl(stream, value)
+        return (stream["count"],)
+
+    def write_png(self, stream, value):
+        images = stream_tensor(value)
+        if images is None:
+            raise Exception("Stream Sink can only write images or masks as png, not %s" % type(value).__name__)
+        if images.dim() == 2:
+            # A single mask rather than a batch of them
+            images = images.unsqueeze(0)
+        for image in images:
+            pixels = np.clip(image.float().numpy() * 255.0, 0, 255).astype(np.uint8)
+            if pixels.ndim == 3 and pixels.shape[-1] == 1:
+                pixels = pixels[..., 0]
+            Image.fromarray(pixels).save("%s%05d.png" % (stream["path"], stream["count"]), compress_level=4)
+            stream["count"] += 1
+
+    def write_npy(self, stream, value):
+        tensor = stream_tensor(value)
+        if tensor is not None:
+            if tensor.dim() == 0:
+                # A single number is one row, like any other value that isn't a batch
+                tensor = tensor.reshape((1,))
+            # numpy has no bfloat16
+            rows = (tensor.float() if tensor.dtype == torch.bfloat16 else tensor).numpy()
+        else:
+            rows = np.asarray(value)
+            rows = rows.reshape((1,) + rows.shape)
+        rows = np.ascontiguousarray(rows)
+        path = stream["path"] + ".npy"
+        if stream["dtype"] is None:
+            stream["dtype"] = rows.dtype
+            stream["shape"] = rows.shape[1:]
+            with open(path, "wb") as f:
+                f.write(npy_header(rows.dtype, (0,) + stream["shape"]))
+        elif rows.dtype != stream["dtype"] or rows.shape[1:] != stream["shape"]:
+            raise Exception("Stream Sink can't append %s %s to a .npy stream of %s %s" % (rows.dtype, rows.shape[1:], stream["dtype"], stream["shape"]))
+        with open(path, "r+b") as f:
+            f.seek(0, os.SEEK_END)
+            f.write(rows.tobytes())
+            stream["count"] += rows.shape[0]
+            f.seek(0)
+            f.write(npy_header(rows.dtype, (stream["count"],) + stream["shape"]))
+
+    def write_jsonl(self, stream, value):
+        with open(stream["path"] + ".jsonl", "a", encoding="utf-8") as f:
+            f.write(json.dumps({"index": stream["count"], "value": value}, default=json_default) + "\n")
+        stream["count"] += 1
+
+STREAM_NODE_CLASS_MAPPINGS = {
+    "StreamSink": StreamSinkNode,
+}
+STREAM_NODE_DISPLAY_NAME_MAPPINGS = {
+    "StreamSink": "Stream Sink",
+}
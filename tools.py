@@ -1,3 +1,32 @@
+import collections
+import hashlib
+import os
+import weakref
+import torch
+
+def setting(name, default):
+    """Reads a pack setting from the INVERSION_DEMO_<NAME> environment variable, converted to the type of default"""
+    value = os.environ.get("INVERSION_DEMO_%s" % name.upper(), None)
+    if value is None:
+        return default
+    if isinstance(default, bool):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    try:
+        return type(default)(value)
+    except ValueError:
+        print("Invalid value for INVERSION_DEMO_%s: %s (using %s)" % (name.upper(), value, default))
+        return default
+
+def describe_node(dynprompt, unique_id):
+    """Names a node for error messages, including the node that expanded it (e.g. the loop it is part of)"""
+    if dynprompt is None:
+        return "node %s" % unique_id
+    display_id = dynprompt.get_display_node_id(unique_id)
+    description = "node %s (%s)" % (display_id, dynprompt.get_node(unique_id)["class_type"])
+    parent_id = dynprompt.get_parent_node_id(unique_id)
+    if parent_id is not None and dynprompt.get_display_node_id(parent_id) != display_id:
+        description += " inside node %s (%s)" % (dynprompt.get_display_node_id(parent_id), dynprompt.get_node(parent_id)["class_type"])
+    return description
 
 def MakeSmartType(t):
     if isinstance(t, str):
@@ -60,6 +89,102 @@ def VariantSupport():
                 return True
                 
             setattr(cls, "VALIDATE_INPUTS", validate_inputs)
+        from .counters import counters_enabled, counted
+        if counters_enabled() and hasattr(cls, "FUNCTION"):
+            setattr(cls, cls.FUNCTION, counted(getattr(cls, cls.FUNCTION), cls.__name__))
+        from .tracing import tracing_enabled, traced
+        if tracing_enabled():
+            for method, category in [(getattr(cls, "FUNCTION", None), "node"), ("check_lazy_status", "lazy")]:
+                if method is not None and hasattr(cls, method):
+                    setattr(cls, method, traced(getattr(cls, method), "%s.%s" % (cls.__name__, method), category))
         return cls
     return decorator
 
+
+def fingerprint(value):
+    """Returns a stable hash of a value, or None if it contains something we don't know how to hash"""
+    hasher = hashlib.blake2b(digest_size=16)
+    if not _update_fingerprint(hasher, value):
+        return None
+    return hasher.hexdigest()
+
+def _update_fingerprint(hasher, value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        hasher.update(("%s:%r;" % (type(value).__name__, value)).encode("utf-8"))
+    elif isinstance(value, torch.Tensor):
+        hasher.update(("Tensor:%s:%s;" % (value.dtype, tuple(value.shape))).encode("utf-8"))
+        flat = value.detach().reshape(-1)
+        hasher.update(flat.contiguous().cpu().view(torch.uint8).numpy().tobytes())
+    elif isinstance(value, (list, tuple)):
+        hasher.update(("%s:%d;" % (type(value).__name__, len(value))).encode("utf-8"))
+        for item in value:
+            if not _update_fingerprint(hasher, item):
+                return False
+    elif isinstance(value, dict):
+        hasher.update(("dict:%d;" % len(value)).encode("utf-8"))
+        for key in sorted(value.keys(), key=repr):
+            if not _update_fingerprint(hasher, key):
+                return False
+            if not _update_fingerprint(hasher, value[key]):
+                return False
+    else:
+        return False
+    return True
+
+def value_nbytes(value):
+    """Returns the number of bytes of tensor data referenced by a value (including inside lists, dicts and accumulations)"""
+    if isinstance(value, torch.Tensor):
+        return value.nelement() * value.element_size()
+    elif isinstance(value, (list, tuple)):
+        return sum(value_nbytes(item) for item in value)
+    elif isinstance(value, dict):
+        return sum(value_nbytes(item) for item in value.values())
+    return 0
+
+_prompt_states = weakref.WeakKeyDictionary()
+
+def prompt_state(dynprompt):
+    """Returns a dict for bookkeeping that should live exactly as long as the prompt being executed"""
+    if dynprompt is None:
+        return {}
+    state = _prompt_states.get(dynprompt, None)
+    if state is None:
+        state = {}
+        _prompt_states[dynprompt] = state
+    return state
+
+def loop_node_state(dynprompt, unique_id, kind):
+    """Returns a dict for one kind of bookkeeping by a node that lives as long as the prompt. Every iteration of a
+    loop is a different node, so the dict is shared by all of them through their display ID."""
+    if dynprompt is None:
+        return {}
+    nodes = prompt_state(dynprompt).setdefault(kind, {})
+    return nodes.setdefault(dynprompt.get_display_node_id(unique_id), {})
+
+class BoundedMemo:
+    """A least-recently-used table limited both by number of entries and by the tensor bytes it references"""
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key][0]
+
+    def put(self, key, value):
+        nbytes = value_nbytes(value)
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[1]
+        if nbytes > self.max_bytes or self.max_entries <= 0:
+            return
+        self.entries[key] = (value, nbytes)
+        self.nbytes += nbytes
+        while len(self.entries) > self.max_entries or self.nbytes > self.max_bytes:
+            self.nbytes -= self.entries.popitem(last=False)[1][1]
@@ -0,0 +1,100 @@
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+from .tools import setting
+
+# Set INVERSION_DEMO_TRACE_FILE to a path to record a timeline of this pack's node functions, lazy status checks,
+# expansions and loop iterations. The file is in the Chrome trace event format and can be opened in Perfetto or
+# chrome://tracing. Events are appended as they happen, so the file is usable even if the server is killed.
+TRACE_FILE = setting("trace_file", "")
+
+# Events are flushed to disk in groups of this many
+TRACE_FLUSH_EVENTS = 256
+
+class Tracer:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.file = open(path, "w", encoding="utf-8")
+        # The JSON array format allows the closing bracket to be missing, which is what lets us stream
+        self.file.write("[\n")
+        self.pid = os.getpid()
+        self.pending = 0
+        atexit.register(self.flush)
+
+    def event(self, name, category, start_ns, end_ns, args):
+        line = json.dumps({
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": start_ns / 1000.0,
+            "dur": (end_ns - start_ns) / 1000.0,
+            "pid": self.pid,
+            "tid": threading.get_ident(),
+            "args": {key: value for key, value in args.items() if value is not None},
+        }, default=repr)
+        with self.lock:
+            self.file.write(line + ",\n")
+            self.pending += 1
+            if self.pending >= TRACE_FLUSH_EVENTS:
+                self.file.flush()
+                self.pending = 0
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+            self.pending = 0
+
+_tracer = Tracer(TRACE_FILE) if TRACE_FILE != "" else None
+
+def tracing_enabled():
+    return _tracer is not None
+
+class Span:
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        _tracer.event(self.name, self.category, self.start, time.perf_counter_ns(), self.args)
+        return False
+
+class NullSpan:
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_null_span = NullSpan()
+
+def span(name, category="pack", **args):
+    """Returns a context manager that records the time spent in it (does nothing when tracing is disabled)"""
+    if _tracer is None:
+        return _null_span
+    return Span(name, category, args)
+
+def traced(function, name, category):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with span(name, category, node=kwargs.get("unique_id", None), iteration=kwargs.get("iteration", None)) as s:
+            result = function(*args, **kwargs)
+            if isinstance(result, dict) and "expand" in result:
+                s.set(expanded_nodes=len(result["expand"]))
+            return result
+    return wrapper
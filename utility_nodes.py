@@ -1,6 +1,13 @@
-from comfy_execution.graph_utils import GraphBuilder
+import itertools
 import torch
-from .tools import VariantSupport
+from .tools import VariantSupport, setting, value_nbytes, describe_node, prompt_state, loop_node_state
+from .expansion import expansion_graph
+from .graph_passes import finalize_expansion
+from .memory import record_memory
+
+# Limit on the tensor data added to accumulations over a whole prompt. Off (0) unless set, since it also counts
+# data that has been dropped from accumulations since.
+MAX_ACCUMULATION_MB = setting("max_accumulation_mb", 0)
 
 @VariantSupport()
 class AccumulateNode:
@@ -16,6 +23,10 @@ class AccumulateNode:
             "optional": {
                 "accumulation": ("ACCUMULATION",),
             },
+            "hidden": {
+                "dynprompt": "DYNPROMPT",
+                "unique_id": "UNIQUE_ID",
+            },
         }
 
     RETURN_TYPES = ("ACCUMULATION",)
@@ -23,11 +34,19 @@ class AccumulateNode:
 
     CATEGORY = "InversionDemo Nodes/Lists"
 
-    def accumulate(self, to_add, accumulation = None):
+    def accumulate(self, to_add, accumulation = None, dynprompt=None, unique_id=None):
         if accumulation is None:
             value = [to_add]
         else:
             value = accumulation["accum"] + [to_add]
+        if dynprompt is not None:
+            # Only the new item is measured, the rest of the accumulation was recorded when it was added
+            record_memory(dynprompt, "accumulation %s" % dynprompt.get_display_node_id(unique_id), to_add, len(value), append=accumulation is not None)
+        # Counted for the whole prompt, since a loop makes a new accumulation on every iteration
+        state = prompt_state(dynprompt)
+        state["accumulated_bytes"] = state.get("accumulated_bytes", 0) + value_nbytes(to_add)
+        if MAX_ACCUMULATION_MB > 0 and state["accumulated_bytes"] > MAX_ACCUMULATION_MB * 1024 * 1024:
+            raise Exception("Accumulation at %s brings the tensor data accumulated by this prompt to %d MB (the limit is %d MB, set by INVERSION_DEMO_MAX_ACCUMULATION_MB)" % (describe_node(dynprompt, unique_id), state["accumulated_bytes"] // (1024 * 1024), MAX_ACCUMULATION_MB))
         return ({"accum": value},)
 
 @VariantSupport()
@@ -216,6 +235,7 @@ class IntMathOperation:
     FUNCTION = "int_math_operation"
 
     CATEGORY = "InversionDemo Nodes/Logic"
+    PURE = True
 
     def int_math_operation(self, a, b, operation):
         if operation == "add":
@@ -232,7 +252,7 @@ class IntMathOperation:
             return (a ** b,)
 
 
-from .flow_control import NUM_FLOW_SOCKETS
+from .flow_control import NUM_FLOW_SOCKETS, MAX_LOOP_ITERATIONS
 @VariantSupport()
 class ForLoopOpen:
     def __init__(self):
@@ -248,7 +268,9 @@ class ForLoopOpen:
                 "initial_value%d" % i: ("*",) for i in range(1, NUM_FLOW_SOCKETS)
             },
             "hidden": {
-                "initial_value0": ("*",)
+                "initial_value0": ("*",),
+                "dynprompt": "DYNPROMPT",
+                "unique_id": "UNIQUE_ID",
             }
         }
 
@@ -258,16 +280,16 @@ class ForLoopOpen:
 
     CATEGORY = "InversionDemo Nodes/Flow"
 
-    def for_loop_open(self, remaining, **kwargs):
-        graph = GraphBuilder()
+    def for_loop_open(self, remaining, dynprompt=None, unique_id=None, **kwargs):
         if "initial_value0" in kwargs:
             remaining = kwargs["initial_value0"]
+        elif MAX_LOOP_ITERATIONS > 0 and prompt_state(dynprompt).get("loop_iterations", 0) + remaining > MAX_LOOP_ITERATIONS:
+            # No point in running up to the limit when we already know we'll hit it
+            raise Exception("For loop %s would bring this prompt to %d loop iterations (the limit is %d, set by INVERSION_DEMO_MAX_LOOP_ITERATIONS)" % (describe_node(dynprompt, unique_id), prompt_state(dynprompt).get("loop_iterations", 0) + remaining, MAX_LOOP_ITERATIONS))
+        graph = expansion_graph(unique_id)
         while_open = graph.node("WhileLoopOpen", condition=remaining, initial_value0=remaining, **{("initial_value%d" % i): kwargs.get("initial_value%d" % i, None) for i in range(1, NUM_FLOW_SOCKETS)})
         outputs = [kwargs.get("initial_value%d" % i, None) for i in range(1, NUM_FLOW_SOCKETS)]
-        return {
-            "result": tuple(["stub", remaining] + outputs),
-            "expand": graph.finalize(),
-        }
+        return finalize_expansion(graph, ["stub", remaining] + outputs, dynprompt, unique_id)
 
 @VariantSupport()
 class ForLoopClose:
@@ -283,6 +305,10 @@ class ForLoopClose:
             "optional": {
                 "initial_value%d" % i: ("*",{"rawLink": True}) for i in range(1, NUM_FLOW_SOCKETS)
             },
+            "hidden": {
+                "dynprompt": "DYNPROMPT",
+                "unique_id": "UNIQUE_ID",
+            },
         }
 
     RETURN_TYPES = tuple(["*"] * (NUM_FLOW_SOCKETS-1))
@@ -291,8 +317,8 @@ class ForLoopClose:
 
     CATEGORY = "InversionDemo Nodes/Flow"
 
-    def for_loop_close(self, flow_control, **kwargs):
-        graph = GraphBuilder()
+    def for_loop_close(self, flow_control, dynprompt=None, unique_id=None, **kwargs):
+        graph = expansion_graph(unique_id)
         while_open = flow_control[0]
         # TODO - Requires WAS-ns. Will definitely want to solve before merging
         sub = graph.node("IntMathOperation", operation="subtract", a=[while_open,1], b=1)
@@ -303,15 +329,94 @@ class ForLoopClose:
                 condition=cond.out(0),
                 initial_value0=sub.out(0),
                 **input_values)
-        return {
-            "result": tuple([while_close.out(i) for i in range(1, NUM_FLOW_SOCKETS)]),
-            "expand": graph.finalize(),
-        }
+        return finalize_expansion(graph, [while_close.out(i) for i in range(1, NUM_FLOW_SOCKETS)], dynprompt, unique_id)
+
+class DebugFormatter:
+    """Formats a value for printing in time linear in the size of the output. Containers are cut off after
+    max_items entries and below max_depth, and formatting stops once max_length characters have been produced.
+    A limit of 0 means no limit."""
+    def __init__(self, max_depth, max_items, max_length, tensor_stats):
+        self.max_depth = max_depth if max_depth > 0 else None
+        self.max_items = max_items if max_items > 0 else None
+        self.max_length = max_length if max_length > 0 else None
+        self.tensor_stats = tensor_stats
+        self.parts = []
+        self.length = 0
+
+    def full(self):
+        return self.max_length is not None and self.length >= self.max_length
+
+    def emit(self, text):
+        if self.full():
+            return
+        if self.max_length is not None and self.length + len(text) > self.max_length:
+            text = text[:self.max_length - self.length]
+        self.parts.append(text)
+        self.length += len(text)
+
+    def format(self, value):
+        self.emit_value(value, 0)
+        result = "".join(self.parts)
+        if self.full():
+            result += "..."
+        return result
+
+    def emit_items(self, items, count, depth, opening, closing, is_dict):
+        self.emit(opening)
+        if self.max_depth is not None and depth >= self.max_depth:
+            if count > 0:
+                self.emit("...%d items" % count)
+            self.emit(closing)
+            return
+        for item in itertools.islice(items, self.max_items):
+            if self.full():
+                return
+            if is_dict:
+                self.emit_value(item[0], depth + 1)
+                self.emit(": ")
+                item = item[1]
+            self.emit_value(item, depth + 1)
+            self.emit(",")
+        if self.max_items is not None and count > self.max_items:
+            self.emit("...%d more" % (count - self.max_items))
+        self.emit(closing)
+
+    def emit_tensor(self, value):
+        text = "Tensor[%s]" % str(value.shape)
+        if self.tensor_stats:
+            text += "(dtype=%s, device=%s" % (value.dtype, value.device)
+            if value.numel() > 0 and not value.is_complex():
+                stats = value.detach()
+                if not stats.is_floating_point():
+                    stats = stats.to(torch.float64)
+                # One pass for both extremes, and a single copy to the host for all three
+                minimum, maximum = torch.aminmax(stats)
+                text += ", min=%g, max=%g, mean=%g" % tuple(torch.stack([minimum, maximum, stats.mean()]).tolist())
+            text += ")"
+        self.emit(text)
+
+    def emit_value(self, value, depth):
+        if self.full():
+            return
+        if isinstance(value, list):
+            self.emit_items(value, len(value), depth, "[", "]", False)
+        elif isinstance(value, tuple):
+            self.emit_items(value, len(value), depth, "(", ")", False)
+        elif isinstance(value, dict):
+            self.emit_items(value.items(), len(value), depth, "{", "}", True)
+        elif isinstance(value, str):
+            self.emit("'%s'" % (value if self.max_length is None else value[:self.max_length - self.length]))
+        elif isinstance(value, bool) or isinstance(value, int) or isinstance(value, float):
+            self.emit(str(value))
+        elif isinstance(value, torch.Tensor):
+            self.emit_tensor(value)
+        else:
+            self.emit(type(value).__name__)
 
 @VariantSupport()
 class DebugPrint:
     def __init__(self):
-        pass
+        self.calls = 0
 
     @classmethod
     def INPUT_TYPES(cls):
@@ -320,6 +425,18 @@ class DebugPrint:
                 "value": ("*",),
                 "label": ("STRING", {"multiline": False}),
             },
+            "optional": {
+                # 0 for no limit, which prints values in full as this node always has
+                "max_depth": ("INT", {"default": 0, "min": 0, "max": 64, "step": 1}),
+                "max_items": ("INT", {"default": 0, "min": 0, "max": 10000, "step": 1}),
+                "max_length": ("INT", {"default": 0, "min": 0, "max": 1000000, "step": 1}),
+                "tensor_stats": ("BOOLEAN", {"default": False}),
+                "print_every": ("INT", {"default": 1, "min": 1, "max": 1000000, "step": 1}),
+            },
+            "hidden": {
+                "dynprompt": "DYNPROMPT",
+                "unique_id": "UNIQUE_ID",
+            },
         }
 
     RETURN_TYPES = ("*",)
@@ -327,34 +444,22 @@ class DebugPrint:
 
     CATEGORY = "InversionDemo Nodes/Debug"
 
-    def debugtype(self, value):
-        if isinstance(value, list):
-            result = "["
-            for i, v in enumerate(value):
-                result += (self.debugtype(v) + ",")
-            result += "]"
-        elif isinstance(value, tuple):
-            result = "("
-            for i, v in enumerate(value):
-                result += (self.debugtype(v) + ",")
-            result += ")"
-        elif isinstance(value, dict):
-            result = "{"
-            for k, v in value.items():
-                result += ("%s: %s," % (self.debugtype(k), self.debugtype(v)))
-            result += "}"
-        elif isinstance(value, str):
-            result = "'%s'" % value
-        elif isinstance(value, bool) or isinstance(value, int) or isinstance(value, float):
-            result = str(value)
-        elif isinstance(value, torch.Tensor):
-            result = "Tensor[%s]" % str(value.shape)
+    def should_print(self, print_every, dynprompt, unique_id):
+        if print_every <= 1:
+            return True
+        # Counted across the iterations of a loop for the prompt
+        if dynprompt is not None and unique_id is not None:
+            state = loop_node_state(dynprompt, unique_id, "debug_print_calls")
+            calls = state.get("calls", 0)
+            state["calls"] = calls + 1
         else:
-            result = type(value).__name__
-        return result
+            calls = self.calls
+            self.calls += 1
+        return calls % print_every == 0
 
-    def debug_print(self, value, label):
-        print("[%s]: %s" % (label, self.debugtype(value)))
+    def debug_print(self, value, label, max_depth=0, max_items=0, max_length=0, tensor_stats=False, print_every=1, dynprompt=None, unique_id=None):
+        if self.should_print(print_every, dynprompt, unique_id):
+            print("[%s]: %s" % (label, DebugFormatter(max_depth, max_items, max_length, tensor_stats).format(value)))
         return (value,)
 
 NUM_LIST_SOCKETS = 10